@@ -54,15 +54,15 @@ with tempfile.TemporaryDirectory() as tmpdir:
             ))
 
         if install_type == "WHEEL":
-            content, filename = rf._get_remote_file_http(ctx=None, src=pip_req)
+            with tempfile.NamedTemporaryFile(dir=tmpdir, delete=False) as f:
+                filename = rf._get_remote_file_http(ctx=None, src=pip_req, f=f)
 
-            if content is None:
+            if filename is None:
                 print(f"Failed to download {requirement}")
+                continue
 
             pip_req = os.path.join(tmpdir, filename)
-
-            with open(pip_req, "wb") as f:
-                f.write(content)
+            os.replace(f.name, pip_req)
 
         result = subprocess.run(
             f"pip install {pip_req}",
@@ -0,0 +1,75 @@
+import argparse
+import json
+import time
+
+from docmaker.context import Context
+from docmaker.docmaker import Docmaker
+from docmaker.hacks import load_hacks
+from docmaker.hooks import Hook, invalidate_hook_plans, run_hooks
+
+ap = argparse.ArgumentParser(description="Measure per-request hook dispatch overhead")
+ap.add_argument("-n", "--requests", type=int, default=200)
+ap.add_argument("-f", "--features", type=int, default=10,
+                help="Number of synthetic features, each hooking every stage")
+args = ap.parse_args()
+
+
+def make_feature(i):
+    # Each synthetic feature hooks every stage, and depends on the one before
+    # it so the toposort has some work to do
+    attrs = {"stateless": True}
+
+    for stage in STAGES:
+        after = [f"Synthetic{i - 1}"] if i else []
+
+        @Hook(stage, after=after)
+        def noop(self, ctx):
+            pass
+
+        noop.__name__ = f"{stage}_{i}"
+        noop.__qualname__ = f"Synthetic{i}.{stage}_{i}"
+        attrs[noop.__name__] = noop
+
+    return type(f"Synthetic{i}", (), attrs)
+
+
+STAGES = [
+    f"{when}_{stage}"
+    for stage in (
+        "initialize", "setup_tmpdir", "collect_metadata", "convert_to_docx",
+        "save_docx", "finalize_docx", "convert_to_pdf", "finalize_pdf",
+        "finalize", "cleanup_tmpdir",
+    )
+    for when in ("pre", "post")
+]
+
+features = [make_feature(i) for i in range(args.features)]
+# Hacks still take part in planning, but there's no document for them to run on
+docmaker = Docmaker(features, {
+    f"hacks.disable_{_method.__name__}": True
+    for _method in load_hacks() if getattr(_method, "hook", None)
+})
+
+
+def dispatch(cold):
+    ctx = Context(docmaker, None, None)
+    for stage in STAGES:
+        if cold:
+            invalidate_hook_plans()
+        run_hooks(ctx, stage)
+
+
+results = {}
+for (name, cold) in (("cold", True), ("warm", False)):
+    dispatch(cold)
+
+    start = time.perf_counter()
+    for _ in range(args.requests):
+        dispatch(cold)
+    elapsed = time.perf_counter() - start
+
+    results[name] = round(elapsed / args.requests * 1000, 4)
+
+results["speedup"] = round(results["cold"] / results["warm"], 1)
+
+print(json.dumps({"ms_per_request": results, "requests": args.requests, "stages": len(STAGES)}))
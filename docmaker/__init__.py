@@ -1,11 +1,16 @@
 import argparse
 import json
 import os
+import sys
 from frontmatter import parse
 
 import requests
 
+from .batch import expand_sources, load_manifest, render_batch
 from .docmaker import Docmaker
+from .features import load_feature
+from .pandoc import get_document_inputs
+from .watch import watch
 from .options import get_features_options_from_environ, load_options_from_file, option_is_false, \
                      option_is_true
 
@@ -18,10 +23,138 @@ def main():
     ap.add_argument("-O", "--output-format")
     # ap.add_argument("-R", "--reference", default="reference.docx")
     ap.add_argument("-U", "--url")
-    ap.add_argument("srcfile")
+    ap.add_argument("-b", "--batch", action="append", default=[],
+                    help="Render every file matching this glob")
+    ap.add_argument("--manifest", help="Render every file listed in this json or yaml file")
+    ap.add_argument("-j", "--jobs", type=int, help="Number of documents to render at once in batch mode")
+    ap.add_argument("-D", "--output-dir", help="Directory for documents rendered in batch mode")
+    ap.add_argument("-w", "--watch", action="store_true",
+                    help="Render again whenever the source files, or the files they use, change")
+    ap.add_argument("--changed-since", metavar="REV",
+                    help="Only render documents whose files changed in git since this commit")
+    ap.add_argument("--changed-until", metavar="REV",
+                    help="Compare to this commit rather than the working tree, with --changed-since")
+    ap.add_argument("srcfile", nargs="?")
     ap.add_argument("outfile", nargs="?")
     args = ap.parse_args()
 
+    batch = bool(args.batch or args.manifest)
+
+    if batch and args.outfile:
+        ap.error("outfile can't be given in batch mode, use -D/--output-dir")
+    if not batch and not args.srcfile:
+        ap.error("srcfile is required")
+    if args.watch and args.url:
+        ap.error("--watch can't be used with -U/--url")
+    if args.changed_until and not args.changed_since:
+        ap.error("--changed-until requires --changed-since")
+    if args.changed_since and not load_feature("GitRepo").is_valid_git_repo(os.getcwd()):
+        ap.error("--changed-since must be run in a git repository")
+
+    if args.watch:
+        if batch:
+            documents = get_batch_documents(args)
+        else:
+            documents = [{"srcfile": args.srcfile, "outfile": args.outfile, "options": {}}]
+
+        try:
+            watch(lambda: get_features_options(args), documents, output_dir=args.output_dir)
+        except KeyboardInterrupt:
+            pass
+        except ValueError as e:
+            ap.error(str(e))
+        return
+
+    features, options, option_files = get_features_options(args)
+
+    if batch:
+        documents = get_batch_documents(args)
+        if args.changed_since:
+            changed = get_changed_documents(args, documents, options, option_files)
+            print(f"{len(changed)} of {len(documents)} documents changed since {args.changed_since}",
+                  file=sys.stderr)
+            documents = changed
+
+        try:
+            report = render_batch(features, options, documents, jobs=args.jobs, output_dir=args.output_dir)
+        except ValueError as e:
+            ap.error(str(e))
+        print(json.dumps(report), file=sys.stderr)
+
+        if report["failed"]:
+            sys.exit(1)
+    elif args.url:
+        verify_ssl = options.pop("verify_ssl", "true")
+        if option_is_false(verify_ssl):
+            verify_ssl = False
+        else:
+            verify_ssl = True
+
+        if args.outfile is None:
+            args.outfile =  "%s.%s" % (args.srcfile.rsplit(".", 1)[0], options["output"])
+
+        with open(args.srcfile, "r") as f:
+            r = requests.post(
+                args.url,
+                params={"feature": features},
+                headers={"user-agent": f"docmaker/{__version__}"},
+                json={
+                    "options": options,
+                    "srcfile": {
+                        "filename": os.path.basename(args.srcfile),
+                        "contents": f.read()
+                    }
+                },
+                verify=verify_ssl
+            )
+
+        if r.status_code != 200:
+            print(r.text)
+        else:
+            with open(args.outfile, "wb") as f:
+                for chunk in r.iter_content(4096):
+                    f.write(chunk)
+    else:
+        if args.changed_since:
+            document = {"srcfile": args.srcfile, "outfile": args.outfile, "options": {}}
+            if not get_changed_documents(args, [document], options, option_files):
+                print(f"{args.srcfile} has not changed since {args.changed_since}")
+                return
+
+        dm = Docmaker(
+            features=features,
+            options=options
+        )
+
+        dm(args.srcfile, args.outfile)
+
+
+def get_batch_documents(args):
+    documents = expand_sources(args.batch)
+    if args.manifest:
+        documents.extend(load_manifest(args.manifest))
+    if args.srcfile:
+        documents.extend(expand_sources([args.srcfile]))
+    return documents
+
+
+def get_changed_documents(args, documents, options, option_files):
+    git_repo = load_feature("GitRepo")
+
+    inputs = {
+        idx: get_document_inputs(document, options) | option_files
+        for (idx, document) in enumerate(documents)
+    }
+
+    changed = git_repo.changed_documents(os.getcwd(), inputs, args.changed_since, args.changed_until)
+
+    return [document for (idx, document) in enumerate(documents) if idx in changed]
+
+
+def get_features_options(args):
+    """Return the features and options given by args, and the files they were read from"""
+    files = set()
+
     features, options = get_features_options_from_environ()
 
     if args.features:
@@ -29,6 +162,7 @@ def main():
 
     for dotfile in (".docmaker.json", ".docmaker.yaml"):
         if os.path.exists(dotfile):
+            files.add(os.path.abspath(dotfile))
             opts, feats = load_options_from_file(dotfile)
             options.update(opts)
             features.extend(feats)
@@ -36,6 +170,8 @@ def main():
     if args.options:
         for opt in args.options:
             if opt[0] == "@":
+                if "://" not in opt:
+                    files.add(os.path.abspath(opt[1:]))
                 opts, feats = load_options_from_file(opt[1:])
                 options.update(opts)
                 features.extend(feats)
@@ -58,6 +194,7 @@ def main():
     if args.metadata:
         for md in args.metadata:
             if md[0] == "@":
+                files.add(os.path.abspath(md[1:]))
                 with open(md[1:], "r") as f:
                     metadata.update(json.load(f))
                 continue
@@ -81,44 +218,7 @@ def main():
 
     features = list(set(features))
 
-    if args.url:
-        verify_ssl = options.pop("verify_ssl", "true")
-        if option_is_false(verify_ssl):
-            verify_ssl = False
-        else:
-            verify_ssl = True
-
-        if args.outfile is None:
-            args.outfile =  "%s.%s" % (args.srcfile.rsplit(".", 1)[0], options["output"])
-
-        with open(args.srcfile, "r") as f:
-            r = requests.post(
-                args.url,
-                params={"feature": features},
-                headers={"user-agent": f"docmaker/{__version__}"},
-                json={
-                    "options": options,
-                    "srcfile": {
-                        "filename": os.path.basename(args.srcfile),
-                        "contents": f.read()
-                    }
-                },
-                verify=verify_ssl
-            )
-
-        if r.status_code != 200:
-            print(r.text)
-        else:
-            with open(args.outfile, "wb") as f:
-                for chunk in r.iter_content(4096):
-                    f.write(chunk)
-    else:
-        dm = Docmaker(
-            features=features,
-            options=options
-        )
-
-        dm(args.srcfile, args.outfile)
+    return features, options, files
 
 from . import _version
 __version__ = _version.get_versions()['version']
@@ -3,115 +3,390 @@ import base64
 import gzip
 import io
 import json
+import mimetypes
 import os
 import re
+import shutil
 import socket
 import tempfile
 import time
 import traceback
-from typing import MutableMapping
+import zipfile
+from concurrent.futures import as_completed, wait
+from functools import partial
 
 import falcon
+import ijson
 import multipart
 import werkzeug.http
 from ruamel.yaml import YAML
 from werkzeug.serving import run_simple
 
+try:
+    import uwsgi
+except ImportError:
+    uwsgi = None
+
+from . import metrics
+from .cache import get_caches
+from .concurrency import get_executor
 from .context import Context
 from .docmaker import Docmaker
 from .features import load_all_features, load_feature
 from .features.remote_files import RemoteFiles
-from .hooks import Hook
+from .hooks import Hook, StopProcessing, get_max_workers
+from .jobs import JobQueue, QueueFull, get_job_store
 from .options import flatten, get_features_options_from_environ
+from .pool import get_pools
+from .spans import walk_spans
+
+
+# Request bodies, and the parts of multipart bodies, larger than this are
+# buffered on disk instead of in memory
+SPOOL_SIZE = 1024 * 1024
+
+
+REQUEST_DURATION = metrics.histogram(
+    "docmaker_request_duration_seconds",
+    "Time taken to handle a request, up to the start of the response",
+    ("route", "method", "status"),
+)
+RENDER_DURATION = metrics.histogram(
+    "docmaker_render_duration_seconds",
+    "Time taken to render a document",
+    ("route",),
+)
+STAGE_DURATION = metrics.histogram(
+    "docmaker_stage_duration_seconds",
+    "Time taken by each stage of rendering a document",
+    ("route", "stage"),
+)
+SPAN_SECONDS = metrics.counter(
+    "docmaker_span_seconds_total",
+    "Time spent in each stage, hook, feature method and conversion",
+    ("route", "span"),
+)
+SPAN_COUNT = metrics.counter(
+    "docmaker_span_count_total",
+    "Number of times each stage, hook, feature method and conversion ran",
+    ("route", "span"),
+)
+CACHE_LOOKUPS = metrics.counter(
+    "docmaker_cache_lookups_total",
+    "Render cache and remote file cache lookups, by result",
+    ("route", "cache", "result"),
+)
+CACHE_HITS = metrics.counter("docmaker_cache_hits_total", "Hits in each cache", ("cache",))
+CACHE_MISSES = metrics.counter("docmaker_cache_misses_total", "Misses in each cache", ("cache",))
+CACHE_HIT_RATIO = metrics.gauge("docmaker_cache_hit_ratio", "Ratio of hits to lookups in each cache", ("cache",))
+JOBS = metrics.gauge("docmaker_jobs", "Jobs waiting for or being rendered", ("state",))
+JOBS_FINISHED = metrics.counter("docmaker_jobs_finished_total", "Jobs that have finished", ("status",))
+POOL_CAPACITY = metrics.gauge("docmaker_pool_capacity", "Conversions each pool can run at once", ("pool",))
+POOL_BUSY = metrics.gauge("docmaker_pool_busy", "Conversions running in each pool", ("pool",))
+POOL_WAITING = metrics.gauge("docmaker_pool_waiting", "Conversions waiting for a worker in each pool", ("pool",))
+POOL_UTILIZATION = metrics.gauge("docmaker_pool_utilization", "Ratio of busy to available capacity in each pool", ("pool",))
+
+# Counters that features add to ctx.timing, as (cache, result)
+CACHE_EVENTS = {
+    "render_cache.hit": ("render_cache", "hit"),
+    "render_cache.miss": ("render_cache", "miss"),
+    "remote_files.cache_hit": ("remote_files", "hit"),
+    "remote_files.cache_stale": ("remote_files", "stale"),
+    "remote_files.cache_revalidated": ("remote_files", "revalidated"),
+    "remote_files.cache_miss": ("remote_files", "miss"),
+}
+
+
+def observe_render(route, ctx):
+    route = route or ""
+
+    RENDER_DURATION.observe(time.perf_counter() - ctx.started, route=route)
+
+    for (depth, record) in walk_spans(ctx.spans):
+        if record["duration"] is None:
+            continue
+
+        if depth == 0:
+            STAGE_DURATION.observe(record["duration"], route=route, stage=record["name"])
+
+        SPAN_SECONDS.inc(record["duration"], route=route, span=record["name"])
+        SPAN_COUNT.inc(route=route, span=record["name"])
+
+    for (name, (cache, result)) in CACHE_EVENTS.items():
+        if ctx.timing.get(name):
+            CACHE_LOOKUPS.inc(ctx.timing[name], route=route, cache=cache, result=result)
+
+    # Jobs and batches render after their response has been sent
+    metrics.flush()
+
+
+def collect_metrics(app):
+    stats = app.job_queue.stats()
+    JOBS.set(stats["queued"], state="queued")
+    JOBS.set(stats["running"], state="running")
+    JOBS_FINISHED.set(stats["completed"], status="completed")
+    JOBS_FINISHED.set(stats["failed"], status="failed")
+
+    for (name, cache) in get_caches().items():
+        stats = cache.stats()
+        lookups = stats["hits"] + stats["misses"]
+
+        CACHE_HITS.set(stats["hits"], cache=name)
+        CACHE_MISSES.set(stats["misses"], cache=name)
+        CACHE_HIT_RATIO.set(stats["hits"] / lookups if lookups else float("nan"), cache=name)
+
+    for metric in (POOL_CAPACITY, POOL_BUSY, POOL_WAITING, POOL_UTILIZATION):
+        metric.clear()
+
+    for (name, pool) in get_pools().items():
+        stats = pool.stats()
+
+        POOL_CAPACITY.set(stats["capacity"], pool=name)
+        POOL_BUSY.set(stats["busy"], pool=name)
+        POOL_WAITING.set(stats["waiting"], pool=name)
+        POOL_UTILIZATION.set(stats["busy"] / stats["capacity"] if stats["capacity"] else 0, pool=name)
 
 
 class DocmakerApi:
+    stateless = True
+
     @Hook("pre_initialize")
     def initialize_api(self, ctx):
         (ctx.__req, ctx.__resp) = ctx.srcfile
         ctx.srcfile = None
         ctx.__req.context = ctx
 
-    @Hook("post_setup_tmpdir")
-    def parse_post_body(self, ctx):
-        start = time.time()
-        form = ctx.__req.stream.read(ctx.__req.content_length or 0)
-        ctx.timing["parse_post_body.read_from_stream"] = round(time.time() - start, 4)
-
-        if ctx.__req.get_header("content-encoding") == "gzip":
-            start = time.time()
-            form = gzip.decompress(form)
-            ctx.timing["parse_post_body.decompress"] = round(time.time() - start, 4)
-
-        content_type, content_type_options = werkzeug.http.parse_options_header(ctx.__req.content_type)
-
-        if content_type == "application/json":
-            start = time.time()
-            form = json.loads(form)
-            ctx.timing["parse_post_body.json_loads"] = round(time.time() - start, 4)
-            ctx._post_body = form
+    @staticmethod
+    def open_post_body(req, decompress=True):
+        """Return the request body as a stream, decompressing it as it's read"""
+        if req.content_length is None and "chunked" in (req.get_header("transfer-encoding") or "").lower():
+            # There's no length to read up to, but the server ends the input
+            # after the last chunk
+            stream = req.stream
+        else:
+            stream = req.bounded_stream
+
+        if decompress and req.get_header("content-encoding") == "gzip":
+            stream = gzip.GzipFile(fileobj=stream, mode="rb")
+
+        return stream
+
+    @staticmethod
+    def build_json_value(event, value, events):
+        """Return the value that starts with (event, value), reading the rest from events"""
+        if event not in ("start_map", "start_array"):
+            return value
+
+        builder = ijson.ObjectBuilder()
+        builder.event(event, value)
+
+        depth = 1
+        for (_, event, value) in events:
+            builder.event(event, value)
+            if event in ("start_map", "start_array"):
+                depth += 1
+            elif event in ("end_map", "end_array"):
+                depth -= 1
+                if depth == 0:
+                    return builder.value
+
+    @staticmethod
+    def decode_base64_file(src, dest):
+        """Decode the base64 in src into dest a chunk at a time, returning its size"""
+        size = 0
+        leftover = b""
+
+        with open(src, "rb") as src_f, open(dest, "wb") as dest_f:
+            while chunk := src_f.read(SPOOL_SIZE):
+                # Like b64decode, skip anything that isn't base64 (line breaks)
+                chunk = leftover + re.sub(rb"[^A-Za-z0-9+/=]", b"", chunk)
+                usable = len(chunk) - len(chunk) % 4
+                (chunk, leftover) = (chunk[:usable], chunk[usable:])
+                size += dest_f.write(base64.b64decode(chunk))
+
+            if leftover:
+                size += dest_f.write(base64.b64decode(leftover))
+
+        return size
+
+    def write_json_contents(self, ctx, value, event, contents, events):
+        """Write the `contents` of a file in a JSON body to a temporary file"""
+        if event != "string":
+            contents = json.dumps(self.build_json_value(event, contents, events))
+            value.setdefault("format", "json")
+
+        return ctx.get_temp_file(content=contents)
+
+    def save_json_file(self, ctx, key, event, value, events, unique=False):
+        """Write a file given in a JSON body to the tmpdir, as it's parsed
+
+        The file is either its contents, or an object with `contents` and
+        optionally `filename`, `base64encoded` and `format`. Each `contents`
+        string is written out as soon as it's parsed, so the file isn't held
+        in memory while it's decoded, or while the rest of the body is read.
+
+        Returns what the file was, and where it was written. With unique, the
+        file is written to a new path even if another has the same filename.
+        """
+        file_info = {}
+
+        if event != "start_map":
+            contents_file = self.write_json_contents(ctx, file_info, event, value, events)
+        else:
+            contents_file = None
 
-            for key in form:
-                start = time.time()
+            for (_, event, item_key) in events:
+                if event == "end_map":
+                    break
 
-                if key == "options":
-                    ctx.options.update(flatten(form[key]))
+                (_, event, item_value) = next(events)
+                if item_key == "contents":
+                    contents_file = self.write_json_contents(ctx, file_info, event, item_value, events)
                 else:
-                    if not isinstance(form[key], MutableMapping):
-                        form[key] = {
-                            "filename": key,
-                            "contents": form[key]
-                        }
+                    file_info[item_key] = self.build_json_value(event, item_value, events)
 
-                    tmpfile = os.path.join(ctx.tmpdir, form[key]["filename"])
+        if contents_file is None:
+            raise falcon.HTTPBadRequest(description=f"{key} has no contents")
 
-                    contents = form[key]["contents"]
+        file_info.setdefault("filename", key)
+        if unique:
+            tmpfile = ctx.get_temp_file(suffix=f"-{os.path.basename(file_info['filename'])}")
+        else:
+            tmpfile = os.path.join(ctx.tmpdir, file_info["filename"])
 
-                    if not isinstance(contents, (bytes, str)):
-                        contents = json.dumps(contents)
+        if file_info.get("base64encoded", False):
+            size = self.decode_base64_file(contents_file, tmpfile)
+            os.unlink(contents_file)
+        else:
+            size = os.path.getsize(contents_file)
+            os.replace(contents_file, tmpfile)
+
+        # Keep what the file was, not what was in it
+        return (dict(file_info, size=size), tmpfile)
+
+    def iter_json_items(self, ctx, stream):
+        """Yield (key, value) for each top-level item of a JSON body
+
+        Only options are parsed into memory in full. Files are written to
+        the tmpdir as they are parsed, and given as (file info, path), where
+        the file info is the object describing them without their contents.
+        """
+        events = ijson.parse(stream, use_float=True)
+
+        for (prefix, event, key) in events:
+            if prefix != "" or event != "map_key":
+                continue
+
+            (_, event, value) = next(events)
+
+            if key == "options":
+                yield (key, self.build_json_value(event, value, events))
+            elif key == "srcfiles":
+                # Several documents, for the batch route
+                if event != "start_array":
+                    raise falcon.HTTPBadRequest(description="srcfiles must be a list")
+
+                # Documents in a batch may share a filename, or have none, so
+                # each is written to its own path
+                items = []
+                for (_, event, value) in events:
+                    if event == "end_array":
+                        break
+                    items.append(self.save_json_file(
+                        ctx, f"srcfile{len(items)}", event, value, events, unique=True
+                    ))
+                yield (key, items)
+            else:
+                yield (key, self.save_json_file(ctx, key, event, value, events))
+
+    def parse_json_body(self, ctx, stream):
+        start = time.perf_counter()
+
+        for (key, value) in self.iter_json_items(ctx, stream):
+            if key == "options":
+                ctx.options.update(flatten(value))
+                ctx._post_body[key] = value
+            elif key == "srcfiles":
+                ctx._post_body[key] = [item for (item, _) in value]
+                for (item, path) in value:
+                    ctx.srcfile = path
+                    ctx.srcfiles.append({
+                        "path": path,
+                        "name": os.path.basename(item["filename"]),
+                        "format": item.get("format"),
+                    })
+            else:
+                (value, path) = value
+                ctx._post_body[key] = value
+
+                if key == "srcfile":
+                    ctx.srcfile = value["filename"]
+                    ctx.srcfiles.append({
+                        "path": path,
+                        "name": os.path.basename(value["filename"]),
+                        "format": value.get("format"),
+                    })
+
+                    if "format" in value:
+                        ctx.srcfile_format = value["format"]
+                elif key == "template":
+                    ctx.options["jinja_template.template_file"] = value["filename"]
+
+            # Each item is parsed as it's read, so its time runs from the end
+            # of the one before
+            ctx.timing[f"parse_post_body.{key}"] = round(time.perf_counter() - start, 4)
+            start = time.perf_counter()
+
+    def parse_multipart_body(self, ctx, stream, boundary):
+        # Parts larger than SPOOL_SIZE are buffered on disk rather than in memory
+        mpparser = multipart.MultipartParser(
+            stream,
+            boundary,
+            spool_limit=SPOOL_SIZE
+        )
 
-                        if "format" not in form[key]:
-                            form[key]["format"] = "json"
-                    elif form[key].get("base64encoded", False):
-                        contents = base64.b64decode(contents)
+        for part in mpparser:
+            start = time.perf_counter()
+            if part.name == "options":
+                opts = YAML().load(part.file)
+                ctx.options.update(flatten(opts))
+                ctx._post_body[part.name] = opts
+            else:
+                if part.filename and not ctx.file_exists_in_temp_dir(part.filename):
+                    tmpfile = os.path.join(ctx.tmpdir, part.filename)
+                else:
+                    tmpfile = ctx.get_temp_file(suffix=part.filename or None)
 
-                    if not isinstance(contents, bytes):
-                        contents = contents.encode()
+                part.save_as(tmpfile)
 
-                    with open(tmpfile, "wb") as f:
-                        f.write(contents)
+                ctx._post_body[part.name] = {
+                    "filename": part.filename,
+                    "size": part.size,
+                }
 
-                    if key == "srcfile":
-                        ctx.srcfile = form[key]["filename"]
+                if part.name == "srcfile":
+                    ctx.srcfile = tmpfile
+                    ctx.srcfiles.append({
+                        "path": tmpfile,
+                        "name": os.path.basename(part.filename or tmpfile),
+                        "format": None,
+                    })
+            part.close()
+            ctx.timing[f"parse_post_body.{part.name}"] = round(time.perf_counter() - start, 4)
 
-                        if "format" in form[key]:
-                            ctx.srcfile_format = form[key]["format"]
-                    elif key == "template":
-                        ctx.options["jinja_template.template_file"] = form[key]["filename"]
-                ctx.timing[f"parse_post_body.{key}"] = round(time.time() - start, 4)
-        elif content_type == "multipart/form-data":
-            mpparser = multipart.MultipartParser(
-                io.BytesIO(form),
-                content_type_options["boundary"]
-            )
+    @Hook("post_setup_tmpdir")
+    def parse_post_body(self, ctx):
+        stream = self.open_post_body(ctx.__req)
 
-            for part in mpparser:
-                start = time.time()
-                if part.name == "options":
-                    opts = YAML().load(part.file)
-                    ctx.options.update(flatten(opts))
-                else:
-                    if part.filename and not ctx.file_exists_in_temp_dir(part.filename):
-                        tmpfile = os.path.join(ctx.tmpdir, part.filename)
-                    else:
-                        tmpfile = ctx.get_temp_file(suffix=part.filename or None)
+        ctx._post_body = {}
+        ctx.srcfiles = []
 
-                    with open(tmpfile, "wb") as f:
-                        f.write(part.raw)
+        content_type, content_type_options = werkzeug.http.parse_options_header(ctx.__req.content_type)
 
-                    if part.name == "srcfile":
-                        ctx.srcfile = tmpfile
-                ctx.timing[f"parse_post_body.{part.name}"] = round(time.time() - start, 4)
+        if content_type == "application/json":
+            self.parse_json_body(ctx, stream)
+        elif content_type == "multipart/form-data":
+            self.parse_multipart_body(ctx, stream, content_type_options["boundary"])
 
         if "features" in ctx.options:
             for feature in ctx.options["features"]:
@@ -133,14 +408,19 @@ class DocmakerApi:
 
     @Hook("pre_cleanup_tmpdir")
     def stream_response(self, ctx):
-        ctx.__resp.stream = open(ctx.output_file, "rb")
-        size = os.stat(ctx.output_file).st_size
+        # Falcon passes an open file to the server's wsgi.file_wrapper, which
+        # uwsgi sends with sendfile() from an offload thread, so the worker is
+        # free as soon as this returns. The file stays readable after the
+        # tmpdir is removed, since it's already open.
+        ctx.__resp.set_stream(
+            open(ctx.output_file, "rb"),
+            os.stat(ctx.output_file).st_size
+        )
 
         srcfile = os.path.basename(ctx.srcfile)
         srcfile = srcfile.rsplit(".", 1)[0]
 
         ctx.__resp.status = falcon.HTTP_OK
-        ctx.__resp.set_header("content-length", size)
         ctx.__resp.set_header("content-disposition",
                               f"attachment; filename={srcfile}.{ctx.output_format}")
 
@@ -149,6 +429,9 @@ class DocmakerApi:
 
 
 class DocmakerResource(Docmaker):
+    # Set when the resource is added to a DocmakerApp, to label its metrics
+    route = None
+
     def __init__(self, features=None, options=None):
         super().__init__(features, options)
         if DocmakerApi not in self.features:
@@ -166,9 +449,271 @@ class DocmakerResource(Docmaker):
         ctx = super().get_context(srcfile, output_file, features=features)
         return ctx
 
+    def render(self, srcfile, output_file=None):
+        ctx = super().render(srcfile, output_file)
+        observe_render(self.route, ctx)
+        return ctx
+
     def on_post(self, req, resp):
         self((req, resp))
 
+    def on_post_batch(self, req, resp):
+        ctx = self.get_context((req, resp))
+
+        # Everything up to and including the tmpdir setup (parsing the body,
+        # downloading remote files, deriving the reference doc) is shared by
+        # the documents in the batch
+        try:
+            self.initialize(ctx)
+            self.setup_tmpdir(ctx)
+        except BaseException:
+            ctx.cleanup_tmpdir()
+            raise
+
+        resp.status = falcon.HTTP_OK
+        resp.content_type = "application/zip"
+        resp.set_header("content-disposition", "attachment; filename=batch.zip")
+        resp.stream = self.render_batch(ctx)
+
+    def render_batch_document(self, ctx, shared, srcfile, output_file):
+        with ctx.fork(None, output_file) as doc_ctx:
+            doc_ctx.setup_tmpdir()
+
+            if hasattr(ctx, "remote_files_fetched"):
+                doc_ctx.remote_files_fetched = ctx.remote_files_fetched
+
+            for path in shared:
+                dest = os.path.join(doc_ctx.tmpdir, os.path.relpath(path, ctx.tmpdir))
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                doc_ctx.link_or_copy(path, dest)
+
+            doc_ctx.srcfile = doc_ctx.link_or_copy(
+                srcfile["path"],
+                os.path.join(doc_ctx.tmpdir, srcfile["name"])
+            )
+            if srcfile["format"]:
+                doc_ctx.srcfile_format = srcfile["format"]
+
+            try:
+                self.process(doc_ctx)
+            except StopProcessing:
+                pass
+
+            observe_render(self.route, doc_ctx)
+
+            return doc_ctx.timing
+
+    def render_batch(self, ctx):
+        srcfiles = {os.path.abspath(srcfile["path"]) for srcfile in ctx.srcfiles}
+        shared = [
+            os.path.join(root, filename)
+            for (root, _, filenames) in os.walk(ctx.tmpdir)
+            for filename in filenames
+            if os.path.join(root, filename) not in srcfiles
+            and os.path.join(root, filename) != ctx.output_file
+        ]
+
+        executor = get_executor(get_max_workers(ctx), "batch")
+
+        futures = {}
+        names = set()
+        for srcfile in ctx.srcfiles:
+            name = srcfile["name"].rsplit(".", 1)[0]
+            while f"{name}.{ctx.output_format}" in names:
+                name = f"{name}_"
+            name = f"{name}.{ctx.output_format}"
+            names.add(name)
+
+            output_file = ctx.get_temp_file(suffix=f".{ctx.output_format}")
+            future = executor.submit(self.render_batch_document, ctx, shared, srcfile, output_file)
+            futures[future] = (name, output_file)
+
+        manifest = {"setup": ctx.timing, "documents": {}}
+        stream = ZipStream()
+
+        try:
+            with zipfile.ZipFile(stream, "w") as zf:
+                # Documents are added as they finish, not in the order given
+                for future in as_completed(futures):
+                    name, output_file = futures[future]
+                    try:
+                        timing = future.result()
+                    except Exception as e:  # pylint: disable=broad-except
+                        manifest["documents"][name] = {"status": "failed", "error": str(e)}
+                    else:
+                        zf.write(output_file, name)
+                        manifest["documents"][name] = {"status": "done", "timing": timing}
+                    os.unlink(output_file)
+
+                    yield stream.drain()
+
+                zf.writestr("batch.json", json.dumps(manifest))
+            yield stream.drain()
+        finally:
+            for future in futures:
+                future.cancel()
+            # Documents that were already rendering still use the reference
+            # doc in our tmpdir
+            wait(futures)
+            ctx.cleanup_tmpdir()
+
+
+class ZipStream(io.RawIOBase):
+    """A write-only stream for zipfile, whose output is drained as it's written"""
+
+    def __init__(self):
+        super().__init__()
+        self._buffer = bytearray()
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buffer += b
+        return len(b)
+
+    def drain(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+class JobsResource:
+    def __init__(self, app):
+        self.app = app
+
+    @staticmethod
+    def get_request_factory(req, size):
+        # Only what describes the request is kept, as the job runs long after
+        # the server is done with this one
+        env = {
+            k: v for (k, v) in req.env.items()
+            if k.startswith("HTTP_") or k in (
+                "REQUEST_METHOD", "SCRIPT_NAME", "PATH_INFO", "QUERY_STRING",
+                "CONTENT_TYPE", "SERVER_NAME", "SERVER_PORT", "SERVER_PROTOCOL",
+                "wsgi.version", "wsgi.url_scheme", "wsgi.errors",
+            )
+        }
+        env.pop("HTTP_TRANSFER_ENCODING", None)
+        env["CONTENT_LENGTH"] = str(size)
+
+        def request_factory(body):
+            job_env = dict(env)
+            job_env["wsgi.input"] = open(body, "rb")
+            return falcon.Request(job_env), falcon.Response()
+
+        return request_factory
+
+    def on_post(self, req, resp):
+        route = req.get_param("route") or self.app.default_route
+        if route not in self.app.render_resources:
+            raise falcon.HTTPBadRequest(description=f"Unknown route: {route}")
+
+        webhook = req.get_param("webhook")
+        if webhook and not self.app.job_queue.allow_webhook(webhook):
+            raise falcon.HTTPBadRequest(description=f"Webhooks to {webhook} are not allowed")
+
+        fd, body = tempfile.mkstemp(prefix="docmaker-job-")
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(DocmakerApi.open_post_body(req, decompress=False), f, SPOOL_SIZE)
+            size = f.tell()
+
+        try:
+            job = self.app.job_queue.submit(
+                self.app.render_resources[route],
+                self.get_request_factory(req, size),
+                body,
+                route=route,
+                webhook=webhook,
+            )
+        except QueueFull:
+            os.unlink(body)
+            raise falcon.HTTPServiceUnavailable(
+                description="Too many jobs are queued",
+                retry_after=30
+            )
+
+        resp.status = falcon.HTTP_ACCEPTED
+        resp.location = f"/jobs/{job['id']}"
+        resp.text = json.dumps(job)
+
+
+class JobResource:
+    def __init__(self, store):
+        self.store = store
+
+    def get_job(self, job_id):
+        try:
+            job = self.store.get(job_id)
+        except ValueError:
+            job = None
+
+        if job is None:
+            raise falcon.HTTPNotFound()
+
+        return job
+
+    def on_get(self, req, resp, job_id):
+        # pylint: disable=unused-argument
+        resp.status = falcon.HTTP_OK
+        resp.text = json.dumps(self.get_job(job_id))
+
+    def on_delete(self, req, resp, job_id):
+        # pylint: disable=unused-argument
+        self.get_job(job_id)
+        self.store.delete(job_id)
+        resp.status = falcon.HTTP_NO_CONTENT
+
+
+class JobResultResource(JobResource):
+    def on_get(self, req, resp, job_id):
+        # pylint: disable=unused-argument
+        job = self.get_job(job_id)
+
+        if job["status"] != "done":
+            resp.status = falcon.HTTP_CONFLICT
+            resp.text = json.dumps(job)
+            return
+
+        stream, size = self.store.open_result(job_id)
+        if stream is None:
+            raise falcon.HTTPNotFound()
+
+        resp.status = falcon.HTTP_OK
+        resp.set_stream(stream, size)
+        if job.get("filename"):
+            resp.content_type = mimetypes.guess_type(job["filename"])[0] or "application/octet-stream"
+            resp.set_header("content-disposition", f"attachment; filename={job['filename']}")
+
+
+class MetricsResource:
+    def on_get(self, req, resp):
+        # pylint: disable=unused-argument
+        resp.status = falcon.HTTP_OK
+        resp.content_type = "text/plain; version=0.0.4; charset=utf-8"
+        resp.text = metrics.render()
+
+
+class MetricsMiddleware:
+    def process_request(self, req, resp):
+        # pylint: disable=unused-argument
+        req.env["docmaker.started"] = time.perf_counter()
+
+    def process_response(self, req, resp, resource, req_succeeded):
+        # pylint: disable=unused-argument
+        started = req.env.get("docmaker.started")
+        if started is None:
+            return
+
+        # Unmatched paths aren't labelled individually, as there's no end to them
+        REQUEST_DURATION.observe(
+            time.perf_counter() - started,
+            route=req.uri_template or "",
+            method=req.method,
+            status=resp.status_code,
+        )
+        metrics.flush()
+
 
 class FeatureListResource:
     def on_get(self, req, resp):
@@ -183,13 +728,27 @@ class HealthCheckResource:
     def on_get(self, req, resp):
         response = {}
 
+        pools = get_pools()
+        if pools:
+            response["pools"] = {name: pool.stats() for (name, pool) in pools.items()}
+
         if req.get_param_as_bool("uno", default=False):
-            try:
-                s = socket.create_connection(("127.0.0.1", 2002))
-            except ConnectionRefusedError:
-                response["error"] = "uno: connection refused"
+            office_pools = [name for name in pools if name.startswith("office")]
+
+            if office_pools:
+                for name in office_pools:
+                    stats = response["pools"][name]
+
+                    # Instances are started on first use, so an empty pool is fine
+                    if stats["breaker"] == "open" or (stats["workers"] and not stats["healthy"]):
+                        response["error"] = f"uno: no healthy instances in {name}"
             else:
-                s.close()
+                try:
+                    s = socket.create_connection(("127.0.0.1", 2002))
+                except ConnectionRefusedError:
+                    response["error"] = "uno: connection refused"
+                else:
+                    s.close()
 
         if "error" in response:
             response["status"] = "err"
@@ -227,11 +786,15 @@ class DocmakerApp(falcon.App):
 
         ctx._app = self
 
+        self.render_resources = {}
+
         self.api__initialize(ctx)
         self.api__setup_feature_list_resource(ctx)
         self.api__setup_health_check_resource(ctx)
         self.api__setup_default_route(ctx)
         self.api__setup_routes_from_environment(ctx)
+        self.api__setup_job_resources(ctx)
+        self.api__setup_metrics_resource(ctx)
 
     @property
     def default_route(self):
@@ -241,6 +804,11 @@ class DocmakerApp(falcon.App):
     def add_route(self, ctx, uri_template, resource, **kwargs):
         super().add_route(uri_template, resource, **kwargs)
 
+        if isinstance(resource, DocmakerResource):
+            resource.route = uri_template
+            self.render_resources[uri_template] = resource
+            super().add_route(f"{uri_template.rstrip('/')}/batch", resource, suffix="batch")
+
     @Hook()
     def api__initialize(self, ctx):
         self.add_error_handler(Exception, error_handler)
@@ -274,6 +842,44 @@ class DocmakerApp(falcon.App):
                 resource = DocmakerResource(features, options)
                 self.add_route(ctx, os.environ[envvar], resource)
 
+    @Hook()
+    def api__setup_job_resources(self, ctx):
+        webhook_hosts = ctx.get("jobs.webhook_hosts") or []
+        if isinstance(webhook_hosts, str):
+            webhook_hosts = [host.strip() for host in webhook_hosts.split(",")]
+
+        store = get_job_store(
+            ctx.get("jobs.store") or os.path.join(tempfile.gettempdir(), "docmaker-jobs"),
+            float(ctx.get("jobs.ttl") or 86400)
+        )
+
+        self.job_queue = JobQueue(
+            store,
+            max_workers=int(ctx.get("jobs.max_workers") or 2),
+            max_queued=int(ctx.get("jobs.max_queued") or 100),
+            webhook_timeout=float(ctx.get("jobs.webhook_timeout") or 10),
+            webhook_hosts=webhook_hosts,
+        )
+
+        self.add_route(ctx, "/jobs", JobsResource(self))
+        self.add_route(ctx, "/jobs/{job_id}", JobResource(store))
+        self.add_route(ctx, "/jobs/{job_id}/result", JobResultResource(store))
+
+    @Hook()
+    def api__setup_metrics_resource(self, ctx):
+        metrics_dir = ctx.get("metrics.dir")
+        if metrics_dir is None and uwsgi is not None and uwsgi.numproc > 1:
+            # Any worker may answer a scrape, so they share their metrics, in a
+            # directory that's new each time uwsgi starts
+            metrics_dir = os.path.join(tempfile.gettempdir(), f"docmaker-metrics-{uwsgi.masterpid()}")
+        if metrics_dir:
+            metrics.share(metrics_dir)
+
+        self.add_middleware(MetricsMiddleware())
+        metrics.add_collector(partial(collect_metrics, self))
+
+        self.add_route(ctx, "/metrics", MetricsResource())
+
 
 app = DocmakerApp()
 
@@ -0,0 +1,178 @@
+import glob
+import os
+import sys
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from ruamel.yaml import YAML
+
+from .docmaker import Docmaker
+from .options import flatten
+
+
+__docmaker = None
+
+
+def load_manifest(filename):
+    """Load the documents listed in a json or yaml manifest
+
+    Each entry is either the path to a source file, or a mapping with a
+    `srcfile` and optionally an `outfile` and `options` for that document.
+    Relative paths are relative to the manifest.
+    """
+    with open(filename, "r") as f:
+        entries = YAML(typ="safe").load(f) or []
+
+    basedir = os.path.dirname(filename)
+
+    documents = []
+    for entry in entries:
+        if isinstance(entry, str):
+            entry = {"srcfile": entry}
+
+        document = {
+            "srcfile": os.path.join(basedir, entry["srcfile"]),
+            "outfile": None,
+            "options": flatten(dict(entry.get("options") or {})),
+        }
+        if entry.get("outfile"):
+            document["outfile"] = os.path.join(basedir, entry["outfile"])
+
+        documents.append(document)
+
+    return documents
+
+
+def expand_sources(patterns):
+    documents = []
+    for pattern in patterns:
+        for srcfile in sorted(glob.glob(pattern, recursive=True)):
+            if os.path.isfile(srcfile):
+                documents.append({"srcfile": srcfile, "outfile": None, "options": {}})
+    return documents
+
+
+def get_output_file(document, output_format, output_dir=None, root=None):
+    if document["outfile"]:
+        return document["outfile"]
+
+    outfile = f"{document['srcfile'].rsplit('.', 1)[0]}.{output_format}"
+    if output_dir:
+        # Keep where the source is under root, so that sources with the same
+        # name in different directories don't overwrite each other
+        root = root or os.path.dirname(os.path.abspath(outfile))
+        outfile = os.path.join(output_dir, os.path.relpath(os.path.abspath(outfile), root))
+
+    return outfile
+
+
+def get_output_files(documents, output_format, output_dir=None):
+    """Return the output file for each document
+
+    Under output_dir, each is at the same path as its source, relative to
+    the directory that holds every source. Raises ValueError if two documents
+    would be written to the same file.
+    """
+    root = None
+    srcdirs = [os.path.dirname(os.path.abspath(document["srcfile"])) for document in documents]
+    if output_dir and srcdirs:
+        root = os.path.commonpath(srcdirs)
+
+    output_files = []
+    seen = {}
+    for document in documents:
+        output_file = get_output_file(document, output_format, output_dir, root)
+
+        other = seen.setdefault(os.path.abspath(output_file), document["srcfile"])
+        if other != document["srcfile"]:
+            raise ValueError(f"{other} and {document['srcfile']} would both be rendered to {output_file}")
+
+        output_files.append(output_file)
+
+    return output_files
+
+
+def init_worker(features, options):
+    # Each process loads features and options once, and then keeps its hook
+    # plans and caches warm for every document it renders
+    global __docmaker
+
+    __docmaker = Docmaker(features=features, options=dict(options, print_timing=False))
+
+
+def render_document(document, output_file):
+    if document["options"]:
+        docmaker = Docmaker(
+            features=__docmaker.features,
+            options=dict(__docmaker.options, **document["options"])
+        )
+    else:
+        docmaker = __docmaker
+
+    start = time.time()
+    try:
+        ctx = docmaker.render(document["srcfile"], output_file)
+    except Exception as e:  # pylint: disable=broad-except
+        return {
+            "srcfile": document["srcfile"],
+            "status": "failed",
+            "error": str(e),
+            "traceback": traceback.format_exc(),
+            "elapsed": round(time.time() - start, 4),
+        }
+
+    return {
+        "srcfile": document["srcfile"],
+        "outfile": ctx.output_file,
+        "status": "done",
+        "timing": dict(ctx.timing),
+        "elapsed": round(time.time() - start, 4),
+    }
+
+
+def render_batch(features, options, documents, jobs=None, output_dir=None):
+    """Render documents across a pool of processes, returning a timing report"""
+    start = time.time()
+
+    output_format = options.get("output") or "pdf"
+    output_files = get_output_files(documents, output_format, output_dir)
+
+    if output_dir:
+        for dirname in {os.path.dirname(output_file) for output_file in output_files}:
+            os.makedirs(dirname, exist_ok=True)
+
+    results = []
+    if jobs == 1:
+        init_worker(features, options)
+        for (document, output_file) in zip(documents, output_files):
+            results.append(render_document(document, output_file))
+    else:
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=init_worker,
+            initargs=(features, options)
+        ) as executor:
+            futures = [
+                executor.submit(render_document, document, output_file)
+                for (document, output_file) in zip(documents, output_files)
+            ]
+
+            for future in as_completed(futures):
+                results.append(future.result())
+
+    timing = {}
+    for result in results:
+        for (name, value) in result.get("timing", {}).items():
+            timing[name] = round(timing.get(name, 0) + value, 4)
+
+        if result["status"] == "failed":
+            print(f"Failed to render {result['srcfile']}: {result['error']}", file=sys.stderr)
+
+    return {
+        "documents": len(results),
+        "done": sum(1 for result in results if result["status"] == "done"),
+        "failed": sum(1 for result in results if result["status"] == "failed"),
+        "elapsed": round(time.time() - start, 4),
+        "timing": timing,
+    }
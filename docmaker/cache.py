@@ -0,0 +1,305 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+
+def make_key(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        elif not isinstance(part, bytes):
+            part = json.dumps(part, sort_keys=True, default=str).encode("utf-8")
+        h.update(hashlib.sha256(part).digest())
+    return h.hexdigest()
+
+
+@lru_cache(maxsize=1024)
+def _hash_file(path, mtime_ns, size):
+    # pylint: disable=unused-argument
+    # mtime and size are only part of the cache key, so a changed file is re-read
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_file(path):
+    st = os.stat(path)
+    return _hash_file(os.path.abspath(path), st.st_mtime_ns, st.st_size)
+
+
+class MemoryCache:
+    """A bounded, least recently used mapping shared by the threads of a process"""
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return self._entries[key]
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+
+class DiskCache:
+    """Files stored under their key, evicting the least recently used
+
+    Entries are written to a temporary file and renamed into place, so
+    several processes can share one cache directory.
+    """
+
+    # How often the cache directory is scanned for what other processes have
+    # added, when our own writes haven't taken it over the limit
+    SCAN_INTERVAL = 60
+
+    def __init__(self, root, max_size=None):
+        self.root = root
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+        # The size and number of entries as of the last scan, plus what we've
+        # written since
+        self._size = None
+        self._count = None
+        self._scanned_at = 0
+
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def count(self, hit):
+        with self._stats_lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def open(self, key):
+        """Return the entry stored under key, open for reading, or None
+
+        Once it's open, the entry can be read in full even if it's evicted.
+        """
+        path = self.path(key)
+
+        try:
+            f = open(path, "rb")
+        except FileNotFoundError:
+            self.count(hit=False)
+            return None
+
+        try:
+            # Reading an entry makes it the most recently used
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+
+        self.count(hit=True)
+        return f
+
+    def get_bytes(self, key):
+        f = self.open(key)
+        if f is None:
+            return None
+
+        with f:
+            return f.read()
+
+    def set(self, key, content=None, filename=None):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                if filename is not None:
+                    with open(filename, "rb") as src:
+                        shutil.copyfileobj(src, f)
+                else:
+                    f.write(content)
+                size = f.tell()
+            os.replace(tmpfile, path)
+        except BaseException:
+            os.unlink(tmpfile)
+            raise
+
+        with self._lock:
+            if self._size is not None:
+                self._size += size
+                self._count += 1
+
+        self.evict()
+        return path
+
+    def entries(self):
+        entries = []
+        for root, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if filename.startswith(".tmp"):
+                    continue
+                path = os.path.join(root, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, path))
+        return entries
+
+    def scan(self):
+        with self._lock:
+            entries = self.entries()
+            self._size = sum(entry[1] for entry in entries)
+            self._count = len(entries)
+            self._scanned_at = time.monotonic()
+            return entries
+
+    def evict(self):
+        if not self.max_size:
+            return
+
+        # The directory is only walked when we know we've gone over the limit,
+        # or haven't looked in a while
+        with self._lock:
+            if (
+                self._size is not None
+                and self._size <= self.max_size
+                and time.monotonic() - self._scanned_at < self.SCAN_INTERVAL
+            ):
+                return
+
+        entries = sorted(self.scan())
+
+        with self._lock:
+            for (_, entry_size, path) in entries:
+                if self._size <= self.max_size:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                self._size -= entry_size
+                self._count -= 1
+
+    def stats(self):
+        with self._lock:
+            scanned = self._size is not None and time.monotonic() - self._scanned_at < self.SCAN_INTERVAL
+        if not scanned:
+            self.scan()
+
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+
+        return {
+            "entries": self._count,
+            "size": self._size,
+            "max_size": self.max_size,
+            "hits": hits,
+            "misses": misses,
+        }
+
+
+__caches = {}
+__caches_lock = threading.Lock()
+
+
+def get_disk_cache(root, max_size=None):
+    root = os.path.abspath(root)
+
+    with __caches_lock:
+        if root not in __caches:
+            __caches[root] = DiskCache(root, max_size)
+        elif max_size:
+            __caches[root].max_size = max_size
+        return __caches[root]
+
+
+def get_memory_cache(name, max_entries=32):
+    with __caches_lock:
+        if name not in __caches:
+            __caches[name] = MemoryCache(max_entries)
+        return __caches[name]
+
+
+def get_caches():
+    with __caches_lock:
+        return dict(__caches)
+
+
+def memoize(ctx, name, key, build):
+    """Get the bytes stored under key, calling build() to create them on a miss
+
+    Values are kept in memory, and also on disk under `cache.dir` if that
+    option is set, so other processes on the same host can use them.
+    """
+    memory = get_memory_cache(name, int(ctx.get("cache.memory_entries") or 32))
+
+    value = memory.get(key)
+    if value is not None:
+        return value
+
+    disk = None
+    if ctx.get("cache.dir"):
+        disk = get_disk_cache(
+            os.path.join(ctx["cache.dir"], name),
+            parse_size(ctx.get("cache.max_size"))
+        )
+        value = disk.get_bytes(key)
+
+    if value is None:
+        value = build()
+        if disk is not None:
+            disk.set(key, content=value)
+
+    return memory.set(key, value)
+
+
+def parse_size(value):
+    if value is None or isinstance(value, int):
+        return value
+
+    value = str(value).strip().upper()
+    for (suffix, multiplier) in (("K", 1024), ("M", 1024 ** 2), ("G", 1024 ** 3)):
+        if value.endswith(suffix) or value.endswith(f"{suffix}B"):
+            return int(float(value.rstrip("B")[:-1]) * multiplier)
+    return int(value.rstrip("B"))
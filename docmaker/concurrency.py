@@ -0,0 +1,110 @@
+import contextvars
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from toposort import toposort_flatten
+
+
+__executors = {}
+__executors_lock = threading.Lock()
+__local = threading.local()
+
+
+def get_executor(max_workers, name="docmaker"):
+    with __executors_lock:
+        if (name, max_workers) not in __executors:
+            __executors[(name, max_workers)] = ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix=name
+            )
+        return __executors[(name, max_workers)]
+
+
+def in_worker():
+    return getattr(__local, "in_worker", False)
+
+
+def _call_in_worker(func, *args):
+    __local.in_worker = True
+    try:
+        return func(*args)
+    finally:
+        __local.in_worker = False
+
+
+def task_dependencies(tasks):
+    """Map the index of each task to the indexes of the tasks it requires
+
+    A task requires another if it lists something in `requires` that the
+    other lists in `provides`. Requirements that no task provides are expected
+    to be available already.
+    """
+    providers = {}
+    for (idx, task) in enumerate(tasks):
+        for name in getattr(task, "provides", None) or []:
+            providers.setdefault(name, set()).add(idx)
+
+    dependencies = {}
+    for (idx, task) in enumerate(tasks):
+        dependencies[idx] = set()
+        for name in getattr(task, "requires", None) or []:
+            dependencies[idx].update(providers.get(name, set()) - {idx})
+
+    return dependencies
+
+
+def run_concurrently(tasks, args=(), max_workers=None):
+    """Run each task as soon as the tasks it depends on have finished
+
+    Tasks run on a shared thread pool, so the total time is that of the
+    longest chain of dependent tasks rather than the sum of all of them. With
+    max_workers of 1 or less, or when called from within a task, the tasks run
+    one after another in dependency order instead.
+
+    If a task fails, no further tasks are started, the ones already running
+    are waited for, and the first exception is raised.
+    """
+    dependencies = task_dependencies(tasks)
+
+    # Checks for cycles, and gives the order for running sequentially
+    order = toposort_flatten(dependencies)
+
+    if not max_workers or max_workers <= 1 or in_worker() or len(tasks) <= 1:
+        for idx in order:
+            tasks[idx](*args)
+        return
+
+    executor = get_executor(max_workers)
+
+    pending = {idx: dependencies[idx] for idx in order}
+    running = {}
+    finished = set()
+    error = None
+
+    while pending or running:
+        if error is None:
+            for idx in [idx for idx in pending if pending[idx] <= finished]:
+                del pending[idx]
+                # Each task runs in a copy of our context, so the spans it
+                # records nest under the one that's open here
+                running[executor.submit(
+                    contextvars.copy_context().run, _call_in_worker, tasks[idx], *args
+                )] = idx
+
+        if not running:
+            break
+
+        done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+        for future in done:
+            idx = running.pop(future)
+            try:
+                future.result()
+            except BaseException as exc:
+                if error is None:
+                    error = exc
+            else:
+                finished.add(idx)
+
+    if error is not None:
+        raise error
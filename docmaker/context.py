@@ -1,20 +1,30 @@
 import os
+import shutil
 import tempfile
+import time
 from collections import OrderedDict
 
-from .features import load_feature
+from docx import Document
+
+from .features import get_feature_instance, load_feature
 from .options import flatten, option_is_false, option_is_true
 
 
 class Context:
+    _docx = None
+    _docxfile = None
+    _docxfile_stamp = None
     _output_file = None
     _reference_doc = None
     _srcfile_format = None
     _tmpdir = None
     __tempfiles = None
+    __tempfile_names = frozenset()
 
     def __init__(self, docmaker, srcfile, output_file, features=None, options=None):
         self.timing = OrderedDict()
+        self.spans = []
+        self.started = time.perf_counter()
 
         self.docmaker = docmaker
         self.srcfile = srcfile
@@ -42,12 +52,20 @@ class Context:
     def __exit__(self, *exc):
         self.cleanup_tmpdir()
 
+    def fork(self, srcfile, output_file=None):
+        """Return a context for another document, with this one's features and options"""
+        ctx = Context(None, srcfile, output_file, features=self._features, options=self.options)
+        ctx.docmaker = self.docmaker
+        ctx.reference_doc = self._reference_doc
+
+        return ctx
+
     def add_feature(self, feature):
         if isinstance(feature, (bytes, str)):
             feature = load_feature(feature)
 
         self._features.append(feature)
-        self.features.append(feature())
+        self.features.append(get_feature_instance(feature))
 
     def add_features(self, features):
         for feature in features:
@@ -62,6 +80,7 @@ class Context:
         fd, tmpfile = tempfile.mkstemp(*args, dir=self.tmpdir, **kwargs)
 
         self.__tempfiles.append(fd)
+        self.__tempfile_names.add(tmpfile)
 
         if content:
             with open(tmpfile, "wb") as f:
@@ -71,9 +90,30 @@ class Context:
 
         return tmpfile
 
+    def link_or_copy(self, src, dest):
+        # Both ends in the tmpdir means both are scratch files, so a hard link
+        # is as good as a copy
+        if self.tmpdir and os.path.dirname(os.path.abspath(dest)) == self.tmpdir:
+            try:
+                if os.path.exists(dest):
+                    os.unlink(dest)
+                os.link(src, dest)
+            except OSError:
+                pass
+            else:
+                return dest
+
+        shutil.copyfile(src, dest)
+        return dest
+
+    def is_temp_file(self, path):
+        """Whether path was named by get_temp_file, rather than after its contents"""
+        return path in self.__tempfile_names
+
     def setup_tmpdir(self):
         self._tmpdir = tempfile.TemporaryDirectory()
         self.__tempfiles = []
+        self.__tempfile_names = set()
 
     def cleanup_tmpdir(self):
         if self.__tempfiles:
@@ -81,6 +121,7 @@ class Context:
                 os.close(fd)
 
             self.__tempfiles = []
+            self.__tempfile_names = set()
 
         if self._tmpdir:
             self._tmpdir.cleanup()
@@ -125,6 +166,41 @@ class Context:
         else:
             return True
 
+    @property
+    def docx(self):
+        if self._docxfile_stamp is not None and self._docxfile_stamp != self._stat(self._docxfile):
+            # Something modified the file we wrote out, pick those changes up
+            self._docx = Document(self._docxfile)
+            self._docxfile_stamp = self._stat(self._docxfile)
+
+        return self._docx
+
+    @docx.setter
+    def docx(self, value):
+        self._docx = value
+        self._docxfile = None
+        self._docxfile_stamp = None
+
+    @property
+    def docxfile(self):
+        # The document is only written to disk when something needs a path
+        if self._docxfile is None and self._docx is not None:
+            self._docxfile = self.get_temp_file(suffix=".docx")
+            self._docx.save(self._docxfile)
+            self._docxfile_stamp = self._stat(self._docxfile)
+
+        return self._docxfile
+
+    @docxfile.setter
+    def docxfile(self, value):
+        self._docxfile = value
+        self._docxfile_stamp = None
+
+    @staticmethod
+    def _stat(filename):
+        st = os.stat(filename)
+        return (st.st_mtime_ns, st.st_size)
+
     @property
     def finalized(self):
         if self.output_format == "md":
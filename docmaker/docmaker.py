@@ -1,3 +1,4 @@
+import io
 import json
 import os
 import shutil
@@ -10,15 +11,18 @@ from collections.abc import Iterable
 from functools import wraps
 
 import frontmatter
-import pypandoc
 from docxcompose.composer import Composer
 from docx import Document
 from toposort import toposort_flatten
 
+from . import pandoc
 from .context import Context
 from .features import FeatureNotFound, load_feature
 from .hacks import load_hacks
-from .hooks import Hook, StopProcessing
+from .hooks import Hook, SkipToFinalize, StopProcessing, run_tasks
+from .office import EXPORT_FILTERS, bridge_available, get_bridge, get_office_pool
+from .pool import WorkerFailed
+from .spans import format_spans, span
 
 
 class Docmaker:
@@ -30,27 +34,47 @@ class Docmaker:
         return Context(self, srcfile, output_file, **kwargs)
 
     def __call__(self, srcfile, output_file=None):
+        return self.render(srcfile, output_file).output_file
+
+    def render(self, srcfile, output_file=None):
+        """Render srcfile, returning the context it was rendered in"""
         with self.get_context(srcfile, output_file) as ctx:
             try:
                 self.initialize(ctx)
 
                 self.setup_tmpdir(ctx)
-                self.collect_metadata(ctx)
-
-                if ctx.output_format != "md":
-                    self.convert_to_docx(ctx)
-                    self.save_docx(ctx)
-                    self.finalize_docx(ctx)
-
-                    if ctx.output_format != "docx":
-                        self.convert_to_pdf(ctx)
-                        self.finalize_pdf(ctx)
-
-                self.finalize(ctx)
+                self.process(ctx)
             except StopProcessing as e:
                 pass
             self.cleanup_tmpdir(ctx)
-            return ctx.output_file
+
+            if ctx.get_as_boolean("print_spans", False):
+                try:
+                    print(format_spans(ctx.spans), file=sys.stderr)
+                except BrokenPipeError:
+                    pass
+
+            return ctx
+
+    def process(self, ctx):
+        """Render the document of a context that already has its tmpdir set up"""
+        try:
+            self.collect_metadata(ctx)
+
+            if ctx.output_format != "md":
+                self.convert_to_docx(ctx)
+                self.save_docx(ctx)
+                self.finalize_docx(ctx)
+
+                if ctx.output_format != "docx":
+                    self.convert_to_pdf(ctx)
+                    self.finalize_pdf(ctx)
+        except SkipToFinalize:
+            # The finalized output is already available, e.g. from
+            # the render cache
+            pass
+
+        self.finalize(ctx)
 
     @Hook()
     def initialize(self, ctx):
@@ -65,16 +89,24 @@ class Docmaker:
         if "metadata" in ctx:
             ctx.metadata.update(ctx["metadata"])
 
-    @Hook(docxfile=lambda ctx: ctx.get_temp_file(suffix=".docx"))
+    @Hook()
     def convert_to_docx(self, ctx):
         if ctx.srcfile is None:
             raise ValueError("No sourcefile provided")
 
         self.get_pypandoc_kwargs(ctx)
 
-        pypandoc.convert_file(
+        # Anything else hooked to build_docx (e.g. the coverpage, the document
+        # header) is built alongside the main pandoc run, and inserted into
+        # the document afterwards
+        run_tasks(ctx, "build_docx", self.run_pandoc)
+
+    @Hook(requires=["pypandoc_kwargs"], provides=["pandoc_output", "src_doc", "composer"])
+    def run_pandoc(self, ctx):
+        ctx.pandoc_output = pandoc.convert_file(
+            ctx,
             ctx.srcfile,
-            outputfile=ctx.docxfile,
+            outputfile=None,
             **ctx.pypandoc_kwargs
         )
 
@@ -106,23 +138,78 @@ class Docmaker:
 
     @Hook()
     def get_src_document(self, ctx):
-        ctx.src_doc = Document(ctx.docxfile)
+        ctx.src_doc = Document(io.BytesIO(ctx.pandoc_output))
+        ctx.docx = ctx.src_doc
 
     @Hook()
     def get_composer(self, ctx):
         ctx.composer = Composer(ctx.src_doc)
         ctx.src_section = ctx.composer.doc.sections[0]
 
-    @Hook(docxfile=lambda ctx: ctx.get_temp_file(suffix=".docx"))
+    @Hook()
     def save_docx(self, ctx):
-        ctx.composer.save(ctx.docxfile)
+        # The document stays in memory, ctx.docxfile is only written out if
+        # something asks for it
+        ctx.docx = ctx.composer.doc
 
     @Hook(finalized_docx=lambda ctx: ctx.get_temp_file(suffix=".docx"))
     def finalize_docx(self, ctx):
-        shutil.copyfile(ctx.docxfile, ctx.finalized_docx)
+        ctx.docx.save(ctx.finalized_docx)
 
     @Hook(pdffile=lambda ctx: ctx.get_temp_file(suffix=".pdf"))
     def convert_to_pdf(self, ctx):
+        use_bridge = ctx.get_as_boolean("unoconv.use_bridge", True)
+
+        if use_bridge and bridge_available() and ctx.output_format in EXPORT_FILTERS:
+            if int(ctx.get("unoconv.pool.size") or 0) > 0:
+                self.convert_to_pdf_with_pool(ctx)
+            else:
+                self.convert_to_pdf_with_bridge(ctx)
+        else:
+            self.convert_to_pdf_with_unoconv(ctx)
+
+    def convert_to_pdf_with_bridge(self, ctx):
+        bridge = get_bridge(
+            ctx.get("unoconv.host") or "127.0.0.1",
+            ctx.get("unoconv.port") or 2002
+        )
+
+        with span(ctx, "office.convert"):
+            bridge.convert(
+                ctx.finalized_docx,
+                ctx.pdffile,
+                ctx.output_format,
+                retries=int(ctx.get("unoconv.retries") or 3)
+            )
+
+    def convert_to_pdf_with_pool(self, ctx):
+        pool = get_office_pool(
+            int(ctx["unoconv.pool.size"]),
+            soffice=ctx.get("unoconv.pool.soffice"),
+            startup_timeout=float(ctx.get("unoconv.pool.startup_timeout") or 30),
+            convert_timeout=float(ctx.get("unoconv.pool.convert_timeout") or 120),
+            lease_timeout=float(ctx.get("unoconv.pool.lease_timeout") or 60),
+            failure_threshold=int(ctx.get("unoconv.pool.failure_threshold") or 5),
+            reset_timeout=float(ctx.get("unoconv.pool.reset_timeout") or 30),
+        )
+
+        retries = int(ctx.get("unoconv.retries") or 3)
+
+        tries = 0
+        while True:
+            try:
+                with span(ctx, "office.lease"), pool.lease() as instance:
+                    with span(ctx, "office.convert"):
+                        instance.convert(ctx.finalized_docx, ctx.pdffile, ctx.output_format)
+            except WorkerFailed:
+                # The instance crashed or hung and has been restarted
+                tries += 1
+                if tries >= retries:
+                    raise
+            else:
+                break
+
+    def convert_to_pdf_with_unoconv(self, ctx):
         unoconv_args = []
         unoconv_kwargs = {}
 
@@ -146,17 +233,18 @@ class Docmaker:
         while tries < retries:
             cpe = None
             try:
-                subprocess.run(
-                    [
-                        shutil.which("unoconv"),
-                        "-f", ctx.output_format,
-                        "-o", ctx.pdffile,
-                        *unoconv_args,
-                        ctx.finalized_docx
-                    ],
-                    check=True,
-                    **unoconv_kwargs
-                )
+                with span(ctx, "unoconv"):
+                    subprocess.run(
+                        [
+                            shutil.which("unoconv"),
+                            "-f", ctx.output_format,
+                            "-o", ctx.pdffile,
+                            *unoconv_args,
+                            ctx.finalized_docx
+                        ],
+                        check=True,
+                        **unoconv_kwargs
+                    )
             except subprocess.CalledProcessError as cpe:
                 tries += 1
             else:
@@ -167,7 +255,7 @@ class Docmaker:
 
     @Hook(finalized_pdf=lambda ctx: ctx.get_temp_file(suffix=".pdf"))
     def finalize_pdf(self, ctx):
-        shutil.copyfile(ctx.pdffile, ctx.finalized_pdf)
+        ctx.link_or_copy(ctx.pdffile, ctx.finalized_pdf)
 
     @Hook()
     def cleanup_tmpdir(self, ctx):
@@ -175,7 +263,10 @@ class Docmaker:
 
     @Hook()
     def finalize(self, ctx):
-        shutil.copyfile(ctx.finalized, ctx.output_file)
+        ctx.link_or_copy(ctx.finalized, ctx.output_file)
+
+        if not ctx.get_as_boolean("print_timing", True):
+            return
 
         try:
             print(json.dumps(ctx.timing), file=sys.stderr)
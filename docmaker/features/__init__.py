@@ -8,10 +8,32 @@ class FeatureNotFound(ModuleNotFoundError):
 
 
 __features = {}
+__instances = {}
+__version = 0
+
+
+def registry_version():
+    return __version
+
+
+def get_feature_instance(feature):
+    # Features that keep no per-document state on self can be shared by every
+    # context, rather than instantiated for each document
+    if not getattr(feature, "stateless", False):
+        return feature()
+
+    if feature not in __instances:
+        __instances[feature] = feature()
+
+    return __instances[feature]
 
 
 def load_all_features():
+    global __version
+
     if not __features:
+        __version += 1
+
         # Crawl docmaker.features once
         parent_module = importlib.import_module("docmaker.features")
         for _, module_name, _ in pkgutil.iter_modules(parent_module.__path__):
@@ -55,6 +77,8 @@ def load_all_features():
 
 
 def load_feature(feature):
+    global __version
+
     if isinstance(feature, type):
         return feature
 
@@ -84,6 +108,10 @@ def load_feature(feature):
 
             __features[feature] = getattr(module, clsname)
 
+        if feature in __features:
+            # A newly registered feature can change how dependencies resolve
+            __version += 1
+
     if feature not in __features:
         # Still not found, throw an error
         raise FeatureNotFound(feature)
@@ -49,6 +49,8 @@ def bugsnag_error_handler(e, req, resp, params):
 
 
 class Bugsnag:
+    stateless = True
+
     @Hook("post_api__initialize", predicate=(
         lambda ctx: "bugsnag.api_key" in ctx,
         lambda ctx: hasattr(ctx, "_app"),
@@ -0,0 +1,121 @@
+import fcntl
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from docmaker.cache import hash_file, make_key
+from docmaker.features.render_cache import RenderCache
+from docmaker.hooks import Hook, StopProcessing
+from docmaker.pandoc import get_document_inputs
+
+
+class BuildManifest:
+    stateless = True
+
+    @staticmethod
+    def get_manifest_file(ctx):
+        return os.path.abspath(ctx.get("build_manifest.file") or ".docmaker-manifest.json")
+
+    @staticmethod
+    def is_on_disk(ctx):
+        """Whether the document is a file given on the command line, rather than
+        one uploaded to the API, which only ever exists in the tmpdir"""
+        if not isinstance(ctx.srcfile, str):
+            return False
+        if ctx.tmpdir is None:
+            return True
+        return not os.path.abspath(ctx.srcfile).startswith(os.path.join(ctx.tmpdir, ""))
+
+    @staticmethod
+    @contextmanager
+    def locked(manifest_file):
+        # Several documents may be rendered at once, each updating the manifest
+        with open(f"{manifest_file}.lock", "w") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def load(manifest_file):
+        try:
+            with open(manifest_file, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    def get_inputs(self, ctx):
+        inputs = RenderCache().get_render_inputs(ctx, exclude_options=("render_cache.", "build_manifest."))
+
+        hashes = {
+            name: make_key(inputs[name])
+            for name in ("options", "metadata", "features", "hacks", "versions")
+        }
+        hashes.update(inputs["assets"])
+
+        # This runs before the tmpdir is set up, so the images and includes the
+        # document links to are found in its source the same way watch does
+        srcfile = os.path.abspath(ctx.srcfile)
+        for path in sorted(get_document_inputs({"srcfile": srcfile, "options": {}}, {}) - {srcfile}):
+            hashes[f"link:{os.path.relpath(path, os.path.dirname(srcfile))}"] = hash_file(path)
+
+        return hashes
+
+    @Hook("post_initialize",
+          build_manifest_inputs=lambda _: None,
+          predicate=lambda ctx: BuildManifest.is_on_disk(ctx))
+    def check_build_manifest(self, ctx):
+        # The inputs are always taken here, even when forced, since by the end
+        # of the render they would include the temp files and metadata too
+        ctx.build_manifest_inputs = self.get_inputs(ctx)
+
+        if ctx.get_as_boolean("build_manifest.force", False):
+            return
+
+        manifest_file = self.get_manifest_file(ctx)
+        output_file = os.path.abspath(ctx.output_file)
+
+        entry = self.load(manifest_file).get(os.path.relpath(output_file, os.path.dirname(manifest_file)))
+        if entry is None or not os.path.exists(output_file):
+            return
+
+        if entry["inputs"] != ctx.build_manifest_inputs:
+            changed = sorted(
+                name for name in set(entry["inputs"]) | set(ctx.build_manifest_inputs)
+                if entry["inputs"].get(name) != ctx.build_manifest_inputs.get(name)
+            )
+            print(f"{ctx.srcfile} needs rebuilt, changed: {', '.join(changed)}")
+            return
+
+        if entry["output"] != hash_file(output_file):
+            return
+
+        print(f"{ctx.srcfile} does not need rebuilt")
+        raise StopProcessing
+
+    @Hook("post_finalize", predicate=(
+        lambda ctx: BuildManifest.is_on_disk(ctx),
+        lambda ctx: getattr(ctx, "build_manifest_inputs", None) is not None,
+    ))
+    def record_build_manifest(self, ctx):
+        inputs = ctx.build_manifest_inputs
+
+        manifest_file = self.get_manifest_file(ctx)
+        output_file = os.path.abspath(ctx.output_file)
+
+        with self.locked(manifest_file):
+            manifest = self.load(manifest_file)
+            manifest[os.path.relpath(output_file, os.path.dirname(manifest_file))] = {
+                "srcfile": os.path.relpath(os.path.abspath(ctx.srcfile), os.path.dirname(manifest_file)),
+                "inputs": inputs,
+                "output": hash_file(output_file),
+                "built": time.time(),
+            }
+
+            fd, tmpfile = tempfile.mkstemp(dir=os.path.dirname(manifest_file), prefix=".tmp")
+            with os.fdopen(fd, "w") as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            os.replace(tmpfile, manifest_file)
@@ -1,4 +1,5 @@
 import datetime
+import io
 import os
 from collections import MutableSequence
 from string import Formatter
@@ -7,11 +8,15 @@ from docx import Document
 from docx.enum.section import WD_SECTION
 from mailmerge import MailMerge
 
+from docmaker.cache import get_memory_cache, hash_file, make_key, memoize
 from docmaker.hooks import Hook
 
 
 class Coverpage:
-    @Hook("pre_convert_to_docx",
+    stateless = True
+
+    @Hook("build_docx",
+          provides=["coverpage_docxfile"],
           coverpage_template=lambda ctx: ctx.get("coverpage.template"),
           predicate=(
               lambda ctx: ctx.coverpage_template,
@@ -19,12 +24,11 @@ class Coverpage:
           )
     )
     def generate_coverpage(self, ctx):
-        ctx.coverpage_docxfile = ctx.get_temp_file()
-
-        doc = MailMerge(ctx.coverpage_template)
+        template_hash = hash_file(ctx.coverpage_template)
+        contents, template = self.get_template(ctx, template_hash)
 
         merge_fields = {}
-        for field_name in doc.get_merge_fields():
+        for field_name in template.get_merge_fields():
             if f"coverpage.{field_name}" in ctx:
                 value = ctx[f"coverpage.{field_name}"]
 
@@ -58,9 +62,41 @@ class Coverpage:
 
             merge_fields[field_name] = value.replace("\\n", "\n")
 
-        # Perform MailMerge
+        # Coverpages are often identical from one document to the next, so
+        # the merged output is kept for the same template and fields
+        merged = memoize(
+            ctx,
+            "coverpage",
+            make_key(template_hash, merge_fields),
+            lambda: self.merge_template(contents, merge_fields)
+        )
+
+        ctx.coverpage_docxfile = ctx.get_temp_file(suffix=".docx", content=merged)
+
+    @staticmethod
+    def get_template(ctx, template_hash):
+        # Templates are read and their merge fields found once
+        templates = get_memory_cache("coverpage_template", int(ctx.get("cache.memory_entries") or 32))
+
+        template = templates.get(template_hash)
+        if template is None:
+            with open(ctx.coverpage_template, "rb") as f:
+                contents = f.read()
+
+            template = templates.set(template_hash, (contents, MailMerge(io.BytesIO(contents))))
+
+        return template
+
+    @staticmethod
+    def merge_template(contents, merge_fields):
+        # Each merge opens its own copy of the template, as merging changes
+        # the document in place
+        doc = MailMerge(io.BytesIO(contents))
         doc.merge(**merge_fields)
-        doc.write(ctx.coverpage_docxfile)
+
+        output = io.BytesIO()
+        doc.write(output)
+        return output.getvalue()
 
     @Hook("post_convert_to_docx", predicate=lambda ctx: hasattr(ctx, "coverpage_docxfile"))
     def insert_coverpage(self, ctx):
@@ -68,19 +104,3 @@ class Coverpage:
         ctx.coverpage_doc.add_section(WD_SECTION.NEW_PAGE)
         ctx.composer.insert(0, ctx.coverpage_doc)
         ctx.coverpage_section = ctx.composer.doc.sections[0]
-
-    @Hook("pre_finalize_docx", after=["sync_header_footer"],
-          predicate=lambda ctx: hasattr(ctx, "coverpage_section"))
-    def drop_header_footer_on_coverpage(self, ctx):
-        # get the header reference from the last section
-        header = ctx.coverpage_section.header
-        headerReference = header._sectPr.get_headerReference(header._hdrftr_index)
-        if headerReference is not None:
-            header._drop_definition()
-
-        # get the footer reference from the last section
-        footer = ctx.composer.doc.sections[-1].footer
-        footerReference = footer._sectPr.get_footerReference(footer._hdrftr_index)
-
-        if footerReference is not None:
-            footer._drop_definition()
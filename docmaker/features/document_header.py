@@ -1,19 +1,45 @@
+import io
 import os
 
-import pypandoc
 from docx import Document
 from docx.enum.section import WD_SECTION
 from jinja2 import Environment
 
+from docmaker import pandoc
+from docmaker.cache import hash_file, make_key, memoize
 from docmaker.hooks import Hook
 
 
 class DocumentHeader:
-    @Hook("post_convert_to_docx", before=["Coverpage", "TableOfContents"], predicate=(
-        lambda ctx: "document_header.file" in ctx,
-        lambda ctx: os.path.exists(ctx["document_header.file"])
-    ))
-    def insert_document_header(self, ctx):
+    stateless = True
+
+    @staticmethod
+    def get_cache_key(ctx):
+        kwargs = dict(ctx.pypandoc_kwargs)
+
+        # The working directory is a new tmpdir for every API request, and the
+        # reference doc is keyed by its contents rather than its path
+        kwargs.pop("cworkdir", None)
+        kwargs["extra_args"] = [
+            arg for arg in kwargs.get("extra_args") or []
+            if not arg.startswith("--reference-doc=")
+        ]
+
+        return make_key(
+            ctx.document_header,
+            kwargs,
+            hash_file(ctx.reference_doc) if ctx.reference_doc else None
+        )
+
+    @Hook("build_docx",
+          requires=["pypandoc_kwargs"],
+          provides=["document_header_doc"],
+          predicate=(
+              lambda ctx: "document_header.file" in ctx,
+              lambda ctx: os.path.exists(ctx["document_header.file"])
+          )
+    )
+    def build_document_header(self, ctx):
         with open(ctx["document_header.file"], "r") as f:
             ctx.document_header = f.read()
 
@@ -22,20 +48,27 @@ class DocumentHeader:
             tpl = env.from_string(ctx.document_header)
             ctx.document_header = tpl.render(**ctx.metadata)
 
-        ctx.document_header_srcfile = ctx.get_temp_file(suffix=".md")
-        with open(ctx.document_header_srcfile, "w") as f:
-            f.write(ctx.document_header)
-
-        ctx.document_header_docxfile = ctx.get_temp_file(suffix=".docx")
-        pypandoc.convert_file(
-            ctx.document_header_srcfile,
-            outputfile=ctx.document_header_docxfile,
-            **ctx.pypandoc_kwargs
+        # Headers are usually a static disclaimer, so the converted header is
+        # kept rather than running pandoc again for the same text
+        contents = memoize(
+            ctx,
+            "document_header",
+            self.get_cache_key(ctx),
+            lambda: pandoc.convert_text(
+                ctx,
+                ctx.document_header,
+                outputfile=None,
+                **ctx.pypandoc_kwargs
+            )
         )
 
-        ctx.document_header_doc = Document(ctx.document_header_docxfile)
+        ctx.document_header_docxfile = ctx.get_temp_file(suffix=".docx", content=contents)
+        ctx.document_header_doc = Document(io.BytesIO(contents))
 
         if ctx.get_as_boolean("document_header.separate_section", False):
             ctx.document_header_doc.add_section(WD_SECTION.NEW_PAGE)
 
+    @Hook("post_convert_to_docx", before=["Coverpage", "TableOfContents"],
+          predicate=lambda ctx: hasattr(ctx, "document_header_doc"))
+    def insert_document_header(self, ctx):
         ctx.composer.insert(0, ctx.document_header_doc)
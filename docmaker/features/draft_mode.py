@@ -5,6 +5,8 @@ from docmaker.hooks import Hook
 
 
 class DraftMode:
+    stateless = True
+
     @Hook("post_initialize", predicate=lambda _: "DOCMAKER_DRAFT_MODE" in os.environ)
     def set_is_draft_mode_from_environ(self, ctx):
         ctx["draft_mode.is_draft"] = os.environ["DOCMAKER_DRAFT_MODE"]
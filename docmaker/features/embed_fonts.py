@@ -23,11 +23,10 @@ def obfuscateTtf(fontstream, guid):
 
 
 class EmbedFonts:
-    @Hook("post_finalize_docx", predicate=(
-        lambda ctx: ctx.output_format == "docx",
-        lambda ctx: ctx.get_options("embed_fonts.fonts"),
-    ))
-    def embed_fonts(self, ctx):
+    stateless = True
+
+    @staticmethod
+    def get_font_dirs(ctx):
         font_dirs = ctx.get("embed_fonts.font_dir")
 
         if font_dirs and not isinstance(font_dirs, Iterable):
@@ -48,7 +47,26 @@ class EmbedFonts:
                     os.path.expanduser("~/Library/Fonts")
                 ])
 
-        font_dirs = filter(os.path.exists, font_dirs)
+        return list(filter(os.path.exists, font_dirs))
+
+    @staticmethod
+    def find_font(font_file, font_dirs):
+        if os.path.exists(font_file):
+            return font_file
+
+        for font_dir in font_dirs:
+            fp = os.path.join(font_dir, font_file)
+            if os.path.exists(fp):
+                return fp
+
+        return None
+
+    @Hook("post_finalize_docx", predicate=(
+        lambda ctx: ctx.output_format == "docx",
+        lambda ctx: ctx.get_options("embed_fonts.fonts"),
+    ))
+    def embed_fonts(self, ctx):
+        font_dirs = self.get_font_dirs(ctx)
 
         with tempfile.TemporaryDirectory(dir=ctx.tmpdir) as tmpdir:
             with zipfile.ZipFile(ctx.finalized_docx) as zf:
@@ -81,16 +99,7 @@ class EmbedFonts:
                     with open(font_file, "wb") as f:
                         f.write(r.content)
 
-                font_path = None
-                if os.path.exists(font_file):
-                    font_path = font_file
-                else:
-                    for font_dir in font_dirs:
-                        fp = os.path.join(font_dir, font_file)
-                        if os.path.exists(fp):
-                            font_path = fp
-                            break
-
+                font_path = self.find_font(font_file, font_dirs)
                 if font_path is None:
                     continue
 
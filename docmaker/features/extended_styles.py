@@ -1,14 +1,18 @@
+import io
 import os
 import shutil
 
 from docx import Document
 from docx.enum.style import WD_STYLE_TYPE
 
+from docmaker.cache import hash_file, make_key, memoize
 from docmaker.hooks import Hook
 
 
 class ExtendedStyles:
-    @Hook("post_initialize", predicate=(
+    stateless = True
+
+    @Hook("post_setup_tmpdir", after=["RemoteFiles", "DocmakerApi.parse_post_body"], predicate=(
         lambda ctx: "extended_styles.file" in ctx,
         lambda ctx: os.path.exists(ctx["extended_styles.file"])
     ))
@@ -19,8 +23,19 @@ class ExtendedStyles:
 
             return
 
-        d1 = Document(ctx.reference_doc)
-        d2 = Document(ctx["extended_styles.file"])
+        contents = memoize(
+            ctx,
+            "extended_styles",
+            make_key(hash_file(ctx.reference_doc), hash_file(ctx["extended_styles.file"])),
+            lambda: self.merge_styles(ctx.reference_doc, ctx["extended_styles.file"])
+        )
+
+        ctx.reference_doc = ctx.get_temp_file(suffix=".docx", content=contents)
+
+    @staticmethod
+    def merge_styles(reference_doc, extended_styles_file):
+        d1 = Document(reference_doc)
+        d2 = Document(extended_styles_file)
 
         for style in d2.styles:
             if style.type != WD_STYLE_TYPE.PARAGRAPH or style.builtin:
@@ -37,5 +52,6 @@ class ExtendedStyles:
                     tab_stop.leader
                 )
 
-        ctx.reference_doc = ctx.get_temp_file(suffix=".docx")
-        d1.save(ctx.reference_doc)
+        output = io.BytesIO()
+        d1.save(output)
+        return output.getvalue()
@@ -1,37 +1,106 @@
 import os
 import re
+from contextlib import contextmanager
 
 import git
 
 from docmaker.hooks import Hook, StopProcessing
 
 
+@contextmanager
+def open_repo(path):
+    """Yield the repo containing path, or None, closing it afterwards"""
+    try:
+        repo = git.Repo(path, search_parent_directories=True)
+    except (git.exc.InvalidGitRepositoryError, git.exc.NoSuchPathError):
+        yield None
+        return
+
+    try:
+        yield repo
+    finally:
+        repo.close()
+
+
 class GitRepo:
+    stateless = True
+
     @classmethod
     def is_valid_git_repo(cls, path):
-        try:
-            git.Repo(path)
-        except git.exc.InvalidGitRepositoryError:
-            return False
-        return True
+        with open_repo(os.path.abspath(path)) as repo:
+            return repo is not None
+
+    @classmethod
+    def changed_files(cls, path, paths, since, until=None):
+        """Return which of paths differ between two commits
+
+        Without until, since is compared to the working tree, and untracked
+        files are included. Only the given paths are diffed, rather than the
+        whole tree, and paths outside the repo are ignored. Raises ValueError
+        if path isn't in a repo.
+        """
+        with open_repo(os.path.abspath(path)) as repo:
+            if repo is None:
+                raise ValueError(f"{os.path.abspath(path)} is not in a git repository")
+
+            return cls._changed_files(repo, paths, since, until)
+
+    @staticmethod
+    def _changed_files(repo, paths, since, until):
+        relpaths = sorted({
+            os.path.relpath(os.path.abspath(p), repo.working_dir) for p in paths
+        })
+        relpaths = [p for p in relpaths if not p.startswith(os.pardir)]
+        if not relpaths:
+            return set()
+
+        revs = [since] if until is None else [since, until]
+        output = repo.git.diff("--name-only", "--no-renames", "-z", *revs, "--", *relpaths)
+
+        if until is None:
+            output += "\0" + repo.git.ls_files("--others", "--exclude-standard", "-z", "--", *relpaths)
+
+        return {os.path.join(repo.working_dir, name) for name in output.split("\0") if name}
+
+    @classmethod
+    def changed_documents(cls, path, inputs, since, until=None):
+        """Return the documents with an input that changed between two commits
+
+        inputs maps each document to the paths of the files it depends on,
+        including itself. All of them are checked with a single diff.
+        """
+        inputs = {document: {os.path.abspath(p) for p in paths} for (document, paths) in inputs.items()}
+
+        changed = cls.changed_files(path, set().union(*inputs.values()), since, until)
+
+        return {document for (document, paths) in inputs.items() if paths & changed}
 
     @Hook("pre_initialize", predicate=(
-        lambda ctx: GitRepo.is_valid_git_repo(os.path.dirname(ctx.srcfile)),
+        # The build manifest knows better whether a rebuild is needed
+        lambda ctx: not any(type(feature).__name__ == "BuildManifest" for feature in ctx.features),
     ))
     def check_file_is_dirty(self, ctx):
-        repo = git.Repo(os.path.dirname(ctx.srcfile))
+        # The repo is opened once here, rather than in a predicate as well
+        with open_repo(os.path.abspath(os.path.dirname(ctx.srcfile))) as repo:
+            if repo is not None:
+                self._check_file_is_dirty(ctx, repo)
+
+    @staticmethod
+    def _check_file_is_dirty(ctx, repo):
         commit = repo.head.commit
         parent = commit.parents[0]
 
+        srcfile = os.path.relpath(os.path.abspath(ctx.srcfile), repo.working_dir)
+
         try:
-            commit_hexsha = commit.tree.join(ctx.srcfile).hexsha
+            commit_hexsha = commit.tree.join(srcfile).hexsha
         except KeyError:
             # Can't find this file in the current commit?????
             # Play it safe
             return True
 
         try:
-            parent_hexsha = parent.tree.join(ctx.srcfile).hexsha
+            parent_hexsha = parent.tree.join(srcfile).hexsha
         except KeyError:
             # Can't find this file in the parent??? It's new.
             return True
@@ -41,8 +110,8 @@ class GitRepo:
             return True
 
         # File is modified and uncommitted
-        modified_files = [item.a_path for item in repo.index.diff(None)]
-        if os.path.relpath(ctx.srcfile, repo.working_dir) in modified_files:
+        modified_files = [item.a_path for item in repo.index.diff(None, paths=[srcfile])]
+        if srcfile in modified_files:
             return True
 
         # Option to force a rebuild generally
@@ -20,6 +20,8 @@ class Environment(jinja2.Environment):
 
 
 class JinjaTemplate:
+    stateless = True
+
     __jinja_filters = {}
 
     @Hook("pre_generate_srcfile",
@@ -4,6 +4,8 @@ from docmaker.hooks import Hook
 
 
 class MarkdownMetadata:
+    stateless = True
+
     @Hook("pre_collect_metadata", predicate=lambda ctx: ctx.srcfile_format == "md")
     def parse_frontmatter(self, ctx):
         with open(ctx.srcfile, "rb") as f:
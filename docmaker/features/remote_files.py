@@ -1,17 +1,118 @@
+import json
 import os
 import re
+import shutil
 import sys
+import tempfile
+import threading
+import time
 from collections import MutableMapping
+from concurrent.futures import Future, wait
+from http.cookiejar import DefaultCookiePolicy
 from urllib.parse import parse_qs, urlparse
 
 import boto3
 import boto3.session
 import requests
+from requests.adapters import HTTPAdapter
 
+from docmaker.cache import get_disk_cache, make_key, parse_size
+from docmaker.concurrency import get_executor
 from docmaker.hooks import Hook
 
 
+__session = None
+__session_lock = threading.Lock()
+__host_limits = {}
+__fetch_lock = threading.Lock()
+__refreshing = set()
+__s3_clients = {}
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def get_session():
+    """Return the requests session shared by the process
+
+    Connections to the same host are kept alive and reused between downloads,
+    and between requests. Cookies are never kept, so nothing set by a server
+    for one request is sent with another's downloads.
+    """
+    global __session
+
+    with __session_lock:
+        if __session is None:
+            session = requests.Session()
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            __session = session
+
+        return __session
+
+
+def get_s3_client(params):
+    """Return an S3 client for a set of credentials and endpoint
+
+    Clients are safe to share between threads, and are kept for the life of
+    the process rather than being set up again for every download.
+    """
+    key = tuple(sorted(params.items()))
+
+    with __session_lock:
+        if key not in __s3_clients:
+            session = boto3.session.Session(**params)
+            __s3_clients[key] = session.client(
+                "s3",
+                **params
+            )
+
+        return __s3_clients[key]
+
+
+def get_host_limit(host, limit):
+    with __session_lock:
+        if (host, limit) not in __host_limits:
+            __host_limits[(host, limit)] = threading.BoundedSemaphore(limit)
+
+        return __host_limits[(host, limit)]
+
+
+def count(ctx, name):
+    with __fetch_lock:
+        ctx.timing[name] = ctx.timing.get(name, 0) + 1
+
+
+def begin_refresh(key):
+    with __fetch_lock:
+        if key in __refreshing:
+            return False
+        __refreshing.add(key)
+        return True
+
+
+def end_refresh(key):
+    with __fetch_lock:
+        __refreshing.discard(key)
+
+
+def get_fetched(ctx, key):
+    """Return the future for a download in this request, and whether it's new"""
+    with __fetch_lock:
+        if not hasattr(ctx, "remote_files_fetched"):
+            ctx.remote_files_fetched = {}
+
+        if key in ctx.remote_files_fetched:
+            return ctx.remote_files_fetched[key], False
+
+        future = ctx.remote_files_fetched[key] = Future()
+        return future, True
+
+
 class RemoteFiles:
+    stateless = True
+
     ACCEPT_HEADER = ", ".join([
         "application/octet-stream",
         "application/*",
@@ -24,15 +125,19 @@ class RemoteFiles:
     def expand_environment_variables(url):
         return url.format(**os.environ)
 
-    def _get_remote_file_http(self, ctx, src):
-        r = requests.get(
+    def _get_remote_file_http(self, ctx, src, f, validators=None):
+        with get_session().get(
             src,
             headers={
                 "accept": self.ACCEPT_HEADER
-            }
-        )
-        if r.status_code != 200:
-            return None, None
+            },
+            stream=True
+        ) as r:
+            if r.status_code != 200:
+                return None
+
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                f.write(chunk)
 
         m = re.search(r"filename=(.+)", r.headers.get("content-disposition", ""))
         if m:
@@ -40,11 +145,40 @@ class RemoteFiles:
         else:
             filename = urlparse(src).path.rsplit("/", 1)[1]
 
-        return r.content, filename
+        if validators is not None:
+            validators["etag"] = r.headers.get("etag")
+            validators["last_modified"] = r.headers.get("last-modified")
+
+        return filename
 
     _get_remote_file_https = _get_remote_file_http
 
-    def _get_remote_file_s3(self, ctx, src):
+    def _revalidate_remote_file_http(self, ctx, src, validators):
+        headers = {"accept": self.ACCEPT_HEADER}
+        if validators.get("etag"):
+            headers["if-none-match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["if-modified-since"] = validators["last_modified"]
+
+        if len(headers) == 1:
+            return False
+
+        r = get_session().head(src, headers=headers, allow_redirects=True)
+
+        if r.status_code == 304:
+            return True
+        if r.status_code != 200:
+            return False
+
+        # Not every server answers conditional requests, so compare too
+        if validators.get("etag"):
+            return r.headers.get("etag") == validators["etag"]
+        return r.headers.get("last-modified") == validators["last_modified"]
+
+    _revalidate_remote_file_https = _revalidate_remote_file_http
+
+    @staticmethod
+    def _get_s3_client(src):
         remote_url = urlparse(src)
 
         params = {k: v[0] for (k, v) in parse_qs(remote_url.query).items()}
@@ -54,19 +188,135 @@ class RemoteFiles:
         if remote_url.password:
             params["aws_secret_access_key"] = remote_url.password
 
-        session = boto3.session.Session(**params)
+        return get_s3_client(params), remote_url.hostname, remote_url.path[1:]
 
-        s3 = session.client(
-            "s3",
-            **params
-        )
+    def _get_remote_file_s3(self, ctx, src, f, validators=None):
+        s3, bucket, key = self._get_s3_client(src)
 
         resp = s3.get_object(
-            Bucket=remote_url.hostname,
-            Key=remote_url.path[1:],
+            Bucket=bucket,
+            Key=key,
+        )
+
+        for chunk in resp["Body"].iter_chunks(chunk_size=CHUNK_SIZE):
+            f.write(chunk)
+
+        if validators is not None:
+            validators["etag"] = resp.get("ETag")
+
+        return os.path.basename(key)
+
+    def _revalidate_remote_file_s3(self, ctx, src, validators):
+        if not validators.get("etag"):
+            return False
+
+        s3, bucket, key = self._get_s3_client(src)
+
+        resp = s3.head_object(
+            Bucket=bucket,
+            Key=key,
+        )
+
+        return resp.get("ETag") == validators["etag"]
+
+    def download(self, ctx, src, f, validators=None):
+        remote_url = urlparse(src)
+        getter = getattr(self, f"_get_remote_file_{remote_url.scheme}")
+
+        max_per_host = int((ctx.get("remote_files.max_per_host") if ctx else None) or 4)
+
+        with get_host_limit(remote_url.hostname, max_per_host):
+            return getter(ctx, src, f, validators=validators)
+
+    def revalidate(self, ctx, src, validators):
+        remote_url = urlparse(src)
+        revalidator = getattr(self, f"_revalidate_remote_file_{remote_url.scheme}", None)
+        if not callable(revalidator):
+            return False
+
+        max_per_host = int((ctx.get("remote_files.max_per_host") if ctx else None) or 4)
+
+        with get_host_limit(remote_url.hostname, max_per_host):
+            return revalidator(ctx, src, validators)
+
+    @staticmethod
+    def get_cache(ctx):
+        if ctx is None or not ctx.get("remote_files.cache.dir"):
+            return None
+
+        return get_disk_cache(
+            ctx["remote_files.cache.dir"],
+            parse_size(ctx.get("remote_files.cache.max_size"))
         )
 
-        return resp["Body"].read(), os.path.basename(remote_url.path)
+    def store(self, cache, key, path, filename, validators):
+        # The URL isn't kept, as it may have credentials in it
+        cache.set(key, filename=path)
+        cache.set(f"{key}-meta", content=json.dumps({
+            "filename": filename,
+            "validators": validators,
+            "fetched_at": time.time(),
+        }).encode("utf-8"))
+
+    def refresh(self, cache, key, src, meta):
+        try:
+            if self.revalidate(None, src, meta["validators"]):
+                meta["fetched_at"] = time.time()
+                cache.set(f"{key}-meta", content=json.dumps(meta).encode("utf-8"))
+                return
+
+            validators = {}
+            with tempfile.NamedTemporaryFile(dir=cache.root, prefix=".tmp") as f:
+                filename = self.download(None, src, f, validators)
+                f.flush()
+                if filename is not None:
+                    self.store(cache, key, f.name, filename, validators)
+        finally:
+            end_refresh(key)
+
+    def get_cached_remote_file(self, ctx, cache, src, f):
+        key = make_key("remote_file", src)
+
+        ttl = float(ctx.get("remote_files.cache.ttl") or 0)
+        stale_while_revalidate = float(ctx.get("remote_files.cache.stale_while_revalidate") or 0)
+
+        meta = cache.get_bytes(f"{key}-meta")
+        cached = cache.open(key) if meta is not None else None
+
+        if cached is not None:
+            with cached:
+                meta = json.loads(meta)
+                age = time.time() - meta["fetched_at"]
+
+                if age < ttl:
+                    state = "hit"
+                elif age < ttl + stale_while_revalidate:
+                    # Use what we have, and bring it up to date for next time
+                    state = "stale"
+                    if begin_refresh(key):
+                        get_executor(16, "remote_files").submit(self.refresh, cache, key, src, meta)
+                elif self.revalidate(ctx, src, meta["validators"]):
+                    state = "revalidated"
+                    meta["fetched_at"] = time.time()
+                    cache.set(f"{key}-meta", content=json.dumps(meta).encode("utf-8"))
+                else:
+                    state = None
+
+                if state is not None:
+                    shutil.copyfileobj(cached, f, CHUNK_SIZE)
+                    count(ctx, f"remote_files.cache_{state}")
+                    return meta["filename"]
+
+        count(ctx, "remote_files.cache_miss")
+
+        validators = {}
+        filename = self.download(ctx, src, f, validators)
+
+        if filename is not None:
+            f.flush()
+            self.store(cache, key, f.name, filename, validators)
+
+        return filename
 
     def get_remote_file(self, ctx, src, filename=None, ext=None, dest=None):
         src = self.expand_environment_variables(src)
@@ -76,60 +326,105 @@ class RemoteFiles:
         if not callable(getter):
             return None
 
-        contents, remote_filename = getter(ctx, src)
+        # Without a dest, the name of the file isn't known until the download
+        # has started, so it's written elsewhere in the tmpdir and moved
+        path = dest if dest is not None else ctx.get_temp_file(suffix=".download")
 
-        if contents is None:
+        cache = self.get_cache(ctx)
+        with open(path, "wb") as f:
+            if cache is not None:
+                remote_filename = self.get_cached_remote_file(ctx, cache, src, f)
+            else:
+                remote_filename = self.download(ctx, src, f)
+
+        if remote_filename is None:
             return None
 
+        if dest is not None:
+            return dest
+
         if not filename:
             filename = remote_filename
 
         if ext:
             filename = f"{filename}.{ext}"
 
-        if dest is None:
-            dest = ctx.get_temp_file(suffix=filename)
-
-        with open(dest, "wb") as f:
-            f.write(contents)
+        dest = ctx.get_temp_file(suffix=filename)
+        os.replace(path, dest)
 
         return dest
 
-    @Hook("post_setup_tmpdir", predicate=lambda ctx: ctx.get_options("remote_files.files"))
+    def fetch(self, ctx, src, filename=None, ext=None):
+        """Download src once per request, however many times it's asked for"""
+        future, new = get_fetched(ctx, (src, filename, ext))
+
+        if new:
+            try:
+                future.set_result(self.get_remote_file(ctx, src, filename=filename, ext=ext))
+            except BaseException as exc:
+                future.set_exception(exc)
+
+        return future.result()
+
+    def fetch_all(self, ctx, srcs):
+        """Download every src at the same time, returning the paths in order"""
+        executor = get_executor(16, "remote_files")
+
+        futures = [executor.submit(self.fetch, ctx, src) for src in srcs]
+        wait(futures)
+
+        return [future.result() for future in futures]
+
+    @Hook("post_setup_tmpdir", parallel_safe=True, predicate=lambda ctx: ctx.get_options("remote_files.files"))
     def download_remote_files_to_tmpdir(self, ctx):
-        for opt_name, remote_file in ctx.get_options("remote_files.files"):
-            ctx[opt_name] = self.get_remote_file(
-                ctx,
-                remote_file
-            )
+        remote_files = ctx.get_options("remote_files.files")
+
+        paths = self.fetch_all(ctx, [remote_file for (_, remote_file) in remote_files])
+
+        for ((opt_name, _), path) in zip(remote_files, paths):
+            ctx[opt_name] = path
 
-    @Hook("post_setup_tmpdir", predicate=(
+    @Hook("post_setup_tmpdir", parallel_safe=True, predicate=(
         lambda ctx: ctx.get("reference"),
         lambda ctx: "://" in ctx["reference"]
     ))
     def download_remote_reference(self, ctx):
-        ctx.reference_doc = self.get_remote_file(
+        ctx.reference_doc = self.fetch(
             ctx,
             ctx["reference"],
             ext="docx"
         )
 
+    @Hook("post_setup_tmpdir", parallel_safe=True, predicate=(
+        lambda ctx: any(type(feature).__name__ == "Coverpage" for feature in ctx.features),
+        lambda ctx: ctx.get("coverpage.template"),
+        lambda ctx: "://" in ctx["coverpage.template"]
+    ))
+    def prefetch_remote_coverpage_template(self, ctx):
+        # Fetched along with everything else, rather than when the coverpage
+        # is generated
+        ctx["coverpage.template"] = self.fetch(
+            ctx,
+            ctx["coverpage.template"],
+            ext=".docx"
+        )
+
     @Hook("pre_generate_coverpage", predicate=(
         lambda ctx: ctx.get("coverpage.template"),
         lambda ctx: "://" in ctx["coverpage.template"]
     ))
     def download_remote_coverpage_template(self, ctx):
-        ctx.coverpage_template = self.get_remote_file(
+        ctx.coverpage_template = self.fetch(
             ctx,
             ctx["coverpage.template"],
             ext=".docx"
         )
 
-    @Hook("post_setup_tmpdir", predicate=(
+    @Hook("post_setup_tmpdir", parallel_safe=True, predicate=(
         lambda ctx: "://" in ctx.srcfile,
     ))
     def download_remote_srcfile(self, ctx):
-        ctx.srcfile = self.get_remote_file(
+        ctx.srcfile = self.fetch(
             ctx,
             ctx.srcfile,
             ext=ctx.get("srcfile_format")
@@ -0,0 +1,165 @@
+import datetime
+import glob
+import os
+import shutil
+
+import pypandoc
+
+from docmaker import __version__
+from docmaker.cache import get_disk_cache, hash_file, make_key, parse_size
+from docmaker.hacks import load_hacks
+from docmaker.hooks import Hook, SkipToFinalize
+
+
+class RenderCache:
+    stateless = True
+
+    @staticmethod
+    def get_cache(ctx):
+        return get_disk_cache(
+            ctx["render_cache.dir"],
+            parse_size(ctx.get("render_cache.max_size"))
+        )
+
+    @staticmethod
+    def hash_value(value, seen):
+        # Options pointing at files are keyed by their contents, not their
+        # path, which is often a random name in the tmpdir
+        if isinstance(value, str) and os.path.isfile(value):
+            seen.add(os.path.abspath(value))
+            return f"sha256:{hash_file(value)}"
+        if isinstance(value, (list, tuple)):
+            return [RenderCache.hash_value(v, seen) for v in value]
+        return value
+
+    def get_render_inputs(self, ctx, exclude_options=("render_cache.",)):
+        """Return everything that goes into rendering a document, with files replaced by their hashes"""
+        seen = set()
+
+        options = {
+            k: self.hash_value(v, seen) for (k, v) in ctx.options.items()
+            if not k.startswith(exclude_options)
+        }
+
+        srcfile = ctx.srcfile
+        if srcfile and not os.path.isabs(srcfile) and ctx.file_exists_in_temp_dir(srcfile):
+            srcfile = os.path.join(ctx.tmpdir, srcfile)
+
+        assets = {
+            "srcfile": self.hash_value(srcfile, seen),
+            "reference_doc": self.hash_value(ctx.reference_doc, seen),
+        }
+
+        if ctx.output_file:
+            seen.add(os.path.abspath(ctx.output_file))
+
+        feature_names = [type(feature).__name__ for feature in ctx.features]
+
+        if "EmbedFonts" in feature_names:
+            embed_fonts = ctx.features[feature_names.index("EmbedFonts")]
+            font_dirs = embed_fonts.get_font_dirs(ctx)
+            for (font_name, font_file) in ctx.get_options("embed_fonts.fonts"):
+                font_path = embed_fonts.find_font(font_file, font_dirs)
+                assets[f"font:{font_name}"] = self.hash_value(font_path or font_file, seen)
+
+        # Anything else in the tmpdir (uploaded images, downloaded files) may be
+        # referenced by the document. Files with names from get_temp_file are
+        # keyed by their contents alone, as the name is different every time.
+        if ctx.tmpdir:
+            temp_files = []
+            for root, _, filenames in os.walk(ctx.tmpdir):
+                for filename in filenames:
+                    path = os.path.join(root, filename)
+                    if os.path.abspath(path) in seen:
+                        continue
+                    if ctx.is_temp_file(path):
+                        temp_files.append(hash_file(path))
+                    else:
+                        assets[f"tmpdir:{os.path.relpath(path, ctx.tmpdir)}"] = hash_file(path)
+
+            if temp_files:
+                assets["tmpdir"] = sorted(temp_files)
+
+        include = ctx.get("render_cache.include") or []
+        if isinstance(include, str):
+            include = [include]
+        for pattern in include:
+            for path in sorted(glob.glob(pattern, recursive=True)):
+                if os.path.isfile(path):
+                    assets[f"include:{path}"] = hash_file(path)
+
+        hacks = sorted(
+            _method.__name__ for _method in load_hacks()
+            if getattr(_method, "hook", None)
+            and not ctx.get_as_boolean(f"hacks.disable_{_method.__name__}", False)
+        )
+
+        versions = {"docmaker": __version__}
+        try:
+            versions["pandoc"] = pypandoc.get_pandoc_version()
+        except OSError:
+            pass
+
+        if "Coverpage" in feature_names and "coverpage.date_format" in ctx:
+            # The coverpage includes today's date
+            versions["date"] = datetime.date.today().isoformat()
+
+        return {
+            "options": options,
+            "metadata": getattr(ctx, "metadata", {}),
+            "assets": assets,
+            "features": sorted(f"{type(f).__module__}.{type(f).__qualname__}" for f in ctx.features),
+            "hacks": hacks,
+            "versions": versions,
+        }
+
+    def get_render_key(self, ctx):
+        inputs = self.get_render_inputs(ctx)
+
+        return make_key(
+            inputs["options"],
+            inputs["metadata"],
+            inputs["assets"],
+            inputs["features"],
+            inputs["hacks"],
+            inputs["versions"],
+        )
+
+    @Hook("post_collect_metadata",
+          render_cache_key=lambda _: None,
+          render_cache_hit=lambda _: False,
+          predicate=(
+              lambda ctx: ctx.get("render_cache.dir"),
+              lambda ctx: ctx.output_format != "md",
+          ))
+    def check_render_cache(self, ctx):
+        ctx.render_cache_key = self.get_render_key(ctx)
+
+        cached = self.get_cache(ctx).open(ctx.render_cache_key)
+
+        if cached is None:
+            ctx.timing["render_cache.hit"] = 0
+            ctx.timing["render_cache.miss"] = 1
+            return
+
+        ctx.timing["render_cache.hit"] = 1
+        ctx.timing["render_cache.miss"] = 0
+        ctx.render_cache_hit = True
+
+        output = ctx.get_temp_file(suffix=f".{ctx.output_format}")
+        with cached, open(output, "wb") as f:
+            shutil.copyfileobj(cached, f)
+
+        if ctx.output_format == "docx":
+            ctx.finalized_docx = output
+        else:
+            ctx.finalized_pdf = output
+
+        raise SkipToFinalize()
+
+    @Hook("pre_finalize", predicate=(
+        lambda ctx: getattr(ctx, "render_cache_key", None),
+        lambda ctx: not ctx.render_cache_hit,
+    ))
+    def store_render_cache(self, ctx):
+        self.get_cache(ctx).set(ctx.render_cache_key, filename=ctx.finalized)
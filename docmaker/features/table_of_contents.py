@@ -1,17 +1,18 @@
-from contextlib import contextmanager
-from multiprocessing import context
+import copy
 
-from docx import Document
 from docx.enum.section import WD_SECTION
 from docx.enum.style import WD_STYLE_TYPE
 from docx.oxml.shared import qn
 
+from docmaker.cache import get_memory_cache
 from docmaker.hooks import Hook
 from docmaker.options import option_is_false
-from docmaker.oxml import OxmlElement
+from docmaker.oxml import OxmlElement, new_document
 
 
 class TableOfContents:
+    stateless = True
+
     @Hook("post_collect_metadata", predicate=(
         lambda ctx: ctx.get_as_boolean("toc.settings_in_metadata", True),
     ))
@@ -26,27 +27,45 @@ class TableOfContents:
                 continue
             ctx[f"toc.{key}"] = ctx.metadata[f"toc_{key}"]
 
-    @Hook("post_convert_to_docx", before=["Coverpage"], predicate=(
+    @Hook("build_docx", provides=["toc_doc"], predicate=(
         lambda ctx: not ctx.get_as_boolean("toc.disabled_by_metadata"),
     ))
-    def insert_table_of_contents(self, ctx):
+    def build_table_of_contents(self, ctx):
         toc_title_text = ctx.get("toc.title_text") or "Table of Contents"
         toc_title_style = ctx.get("toc.title_style") or "TOC Heading"
         toc_depth = int(ctx.get("toc.depth") or 3)
 
-        # ---
+        # The TOC only depends on these settings, so it's built once for each
+        # combination and every document gets a copy
+        toc_docs = get_memory_cache("toc_fragment", int(ctx.get("cache.memory_entries") or 32))
+
+        key = (toc_title_text, toc_title_style, toc_depth)
 
-        ctx.toc_doc = Document()
+        toc_doc = toc_docs.get(key)
+        if toc_doc is None:
+            toc_doc = toc_docs.set(key, self.build_toc_doc(*key))
 
-        if toc_title_style not in ctx.toc_doc.styles:
-            ctx.toc_doc.styles.add_style(toc_title_style, WD_STYLE_TYPE.PARAGRAPH)
+        ctx.toc_doc = copy.deepcopy(toc_doc)
 
-        pPr = ctx.toc_doc.styles[toc_title_style]._element.get_or_add_pPr()
+    @Hook("post_convert_to_docx", before=["Coverpage"],
+          predicate=lambda ctx: hasattr(ctx, "toc_doc"))
+    def insert_table_of_contents(self, ctx):
+        ctx.composer.insert(0, ctx.toc_doc)
+        ctx.toc_section = ctx.composer.doc.sections[0]
+
+    @staticmethod
+    def build_toc_doc(toc_title_text, toc_title_style, toc_depth):
+        toc_doc = new_document()
+
+        if toc_title_style not in toc_doc.styles:
+            toc_doc.styles.add_style(toc_title_style, WD_STYLE_TYPE.PARAGRAPH)
+
+        pPr = toc_doc.styles[toc_title_style]._element.get_or_add_pPr()
 
         with OxmlElement("w:outlineLvl", append_to=pPr) as outlineLvl:
             outlineLvl.set(qn("w:val"), "9")
 
-        toc_p = ctx.toc_doc.add_paragraph(text=toc_title_text, style=toc_title_style)
+        toc_p = toc_doc.add_paragraph(text=toc_title_text, style=toc_title_style)
 
         with OxmlElement("w:sdt", next_to=toc_p._element) as w_sdt:
             with OxmlElement("w:sdtPr", append_to=w_sdt) as w_sdtPr:
@@ -73,11 +92,9 @@ class TableOfContents:
                         with OxmlElement("w:fldChar", append_to=w_r) as w_fldChar_end:
                             w_fldChar_end.set(qn("w:fldCharType"), "end")
 
-        # ---
+        toc_doc.add_section(WD_SECTION.NEW_PAGE)
 
-        ctx.toc_doc.add_section(WD_SECTION.NEW_PAGE)
-        ctx.composer.insert(0, ctx.toc_doc)
-        ctx.toc_section = ctx.composer.doc.sections[0]
+        return toc_doc
 
     @Hook("pre_save_docx")
     def fix_toc_heading_outline_level(self, ctx):
@@ -1,16 +1,13 @@
-import os
+import io
 import subprocess
-import sys
-import tempfile
-import uuid
 import zipfile
-from collections import Iterable
+from functools import lru_cache
 
-import requests
 from defusedxml.lxml import fromstring
 from lxml import etree
 from pypandoc import get_pandoc_path
 
+from docmaker.cache import hash_file, make_key, memoize
 from docmaker.hooks import Hook
 
 
@@ -30,42 +27,57 @@ THEME_COLORS = (
 )
 
 
+@lru_cache(maxsize=None)
+def get_default_reference_docx(pandoc_path):
+    return subprocess.run(
+        [
+            pandoc_path,
+            "--print-default-data-file", "reference.docx"
+        ],
+        check=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    ).stdout
+
+
 class Theme:
+    stateless = True
+
     @Hook("pre_convert_to_docx", predicate=(
         lambda ctx: ctx.get_options("theme")
     ))
     def update_theme_xml(self, ctx):
         if ctx.reference_doc is None:
-            ctx._reference_doc = ctx.get_temp_file(suffix=".docx")
-
-            subprocess.run(
-                [
-                    get_pandoc_path(),
-                    "-o", ctx.reference_doc,
-                    "--print-default-data-file", "reference.docx"
-                ],
-                check=True,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-            )
-
-        with tempfile.TemporaryDirectory(dir=ctx.tmpdir) as tmpdir:
-            with zipfile.ZipFile(ctx.reference_doc) as zf:
-                zf.extractall(tmpdir)
-
-            styles_xml_file = os.path.join(tmpdir, "word", "styles.xml")
-            theme_xml_file = os.path.join(tmpdir, "word", "theme", "theme1.xml")
-
-            if not os.path.exists(theme_xml_file):
-                return
-
-            with open(styles_xml_file, "rb") as f:
-                styles_xml = fromstring(f.read())
-            with open(theme_xml_file, "rb") as f:
-                theme_xml = fromstring(f.read())
+            reference = get_default_reference_docx(get_pandoc_path())
+            reference_hash = make_key(reference)
+        else:
+            with open(ctx.reference_doc, "rb") as f:
+                reference = f.read()
+            reference_hash = hash_file(ctx.reference_doc)
+
+        # The same reference doc and theme always produce the same result, so
+        # routes with a fixed theme only build it once
+        contents = memoize(
+            ctx,
+            "theme",
+            make_key(reference_hash, sorted(ctx.get_options("theme"))),
+            lambda: self.apply_theme(ctx, reference)
+        )
+
+        ctx._reference_doc = ctx.get_temp_file(suffix=".docx", content=contents)
+
+    @staticmethod
+    def apply_theme(ctx, reference):
+        with zipfile.ZipFile(io.BytesIO(reference)) as zf:
+            try:
+                styles_xml = fromstring(zf.read("word/styles.xml"))
+                theme_xml = fromstring(zf.read("word/theme/theme1.xml"))
+            except KeyError:
+                return reference
 
             clrScheme = theme_xml.find("a:themeElements/a:clrScheme", namespaces=theme_xml.nsmap)
 
+            colors = {}
             for color in THEME_COLORS:
                 if f"theme.color_{color}" not in ctx:
                     continue
@@ -85,14 +97,18 @@ class Theme:
                     attribute_name = "val"
 
                 clr.attrib[attribute_name] = colorValue
+                colors[color] = colorValue
+
+            if colors:
+                themeColor = etree.QName(styles_xml.nsmap["w"], "themeColor")
+                val = etree.QName(styles_xml.nsmap["w"], "val")
 
                 for style in styles_xml.findall("w:style", namespaces=styles_xml.nsmap):
                     clr = style.find("w:rPr/w:color", namespaces=styles_xml.nsmap)
                     if clr is None:
                         continue
-                    if clr.get(etree.QName(styles_xml.nsmap["w"], "themeColor")) != color:
-                        continue
-                    clr.set(etree.QName(styles_xml.nsmap["w"], "val"), colorValue)
+                    if clr.get(themeColor) in colors:
+                        clr.set(val, colors[clr.get(themeColor)])
 
             fontScheme = theme_xml.find("a:themeElements/a:fontScheme", namespaces=theme_xml.nsmap)
 
@@ -104,20 +120,14 @@ class Theme:
                 latinFont = fontScheme.find("a:minorFont/a:latin", namespaces=theme_xml.nsmap)
                 latinFont.attrib["typeface"] = ctx["theme.minor_font"]
 
-            with open(styles_xml_file, "wb") as f:
-                f.write(etree.tostring(styles_xml, encoding="utf-8", standalone="yes"))
-            with open(theme_xml_file, "wb") as f:
-                f.write(etree.tostring(theme_xml, encoding="utf-8", standalone="yes"))
-
-            ctx._reference_doc = ctx.get_temp_file(suffix=".docx")
-
-            with zipfile.ZipFile(ctx.reference_doc, "w") as zf:
-                def addToZip(path, zippath):
-                    if os.path.isfile(path):
-                        zf.write(path, zippath, zipfile.ZIP_DEFLATED)
-                    elif os.path.isdir(path):
-                        if zippath:
-                            zf.write(path, zippath)
-                        for nm in sorted(os.listdir(path)):
-                            addToZip(os.path.join(path, nm), os.path.join(zippath, nm))
-                addToZip(tmpdir, "")
+            replacements = {
+                "word/styles.xml": etree.tostring(styles_xml, encoding="utf-8", standalone="yes"),
+                "word/theme/theme1.xml": etree.tostring(theme_xml, encoding="utf-8", standalone="yes"),
+            }
+
+            output = io.BytesIO()
+            with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as out:
+                for item in zf.infolist():
+                    out.writestr(item.filename, replacements.get(item.filename) or zf.read(item))
+
+        return output.getvalue()
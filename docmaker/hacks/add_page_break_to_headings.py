@@ -2,6 +2,7 @@ import re
 
 from docx.enum.style import WD_STYLE_TYPE
 from docx.oxml.shared import qn
+from docx.styles.style import StyleFactory
 # from docx.oxml.text.parfmt import CT_PPr
 # from docx.oxml.xmlchemy import ZeroOrOne
 
@@ -12,17 +13,19 @@ from docmaker.oxml import OxmlElement
 # CT_PPr.outlineLvl = ZeroOrOne("w:outlineLvl")
 
 
-@Hook("pre_save_docx")
+@Hook("pre_save_docx", visit=["w:style"])
 def add_page_break_to_headings(ctx):
     heading_levels_with_break = ctx.get("hacks.page_break_before_headings") or [1]
 
-    for heading_style in ctx.composer.doc.styles:
+    def visit_style(style):
+        heading_style = StyleFactory(style)
+
         if not heading_style.type == WD_STYLE_TYPE.PARAGRAPH:
-            continue
+            return
 
         m = re.match(r"^Heading (\d+)$", heading_style.name)
         if not m:
-            continue
+            return
 
         heading_level = int(m.groups()[0])
 
@@ -59,3 +62,5 @@ def add_page_break_to_headings(ctx):
 
         with OxmlElement("w:outlineLvl", append_to=pPr) as outlineLvl:
             outlineLvl.set(qn("w:val"), str(heading_level - 1))
+
+    return visit_style
@@ -1,18 +1,25 @@
-from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
 
 from docmaker.hooks import Hook
 
 
-@Hook("pre_finalize_docx")
+@Hook("pre_finalize_docx", visit=["w:tbl"])
 def convert_single_row_tables(ctx):
-    d = Document(ctx.docxfile)
+    d = ctx.docx
+    body = d.element.body
 
     style_name = ctx.get("hacks.single_row_table_style") or "Normal Table"
     if style_name not in d.styles:
-        return
+        return None
 
-    for table in d.tables:
-        if len(table.rows) == 1:
-            table.style = d.styles[style_name]
+    style_id = d.part.get_style_id(d.styles[style_name], WD_STYLE_TYPE.TABLE)
 
-    d.save(ctx.docxfile)
+    def visit_table(tbl):
+        # Only top-level tables, i.e. d.tables
+        if tbl.getparent() is not body:
+            return
+
+        if len(tbl.tr_lst) == 1:
+            tbl.tblStyle_val = style_id
+
+    return visit_table
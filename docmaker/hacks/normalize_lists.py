@@ -1,32 +1,36 @@
-from docx import Document
+from docx.enum.style import WD_STYLE_TYPE
 
 from docmaker.hooks import Hook
 
 
-@Hook("pre_finalize_docx")
+@Hook("pre_finalize_docx", visit=["w:p"])
 def normalize_lists(ctx):
-    d = Document(ctx.docxfile)
-
-    for p in d.paragraphs:
-        if p._p.find("./{http://schemas.openxmlformats.org/wordprocessingml/2006/main}pPr/{http://schemas.openxmlformats.org/wordprocessingml/2006/main}numPr") is None:
-            continue
-        pPr = p._p.get_or_add_pPr()
+    d = ctx.docx
+    body = d.element.body
+
+    list_styles = {}
+    for ilvl in range(5):
+        style_name = "List Bullet" if ilvl == 0 else "List Bullet %s" % (ilvl + 1)
+        if style_name in d.styles:
+            list_styles[ilvl] = d.part.get_style_id(d.styles[style_name], WD_STYLE_TYPE.PARAGRAPH)
+
+    def visit_paragraph(p):
+        # Only top-level paragraphs, i.e. d.paragraphs
+        if p.getparent() is not body:
+            return
+
+        if p.find("./{http://schemas.openxmlformats.org/wordprocessingml/2006/main}pPr/{http://schemas.openxmlformats.org/wordprocessingml/2006/main}numPr") is None:
+            return
+        pPr = p.get_or_add_pPr()
         numPr = pPr.get_or_add_numPr()
         ilvl = numPr.get_or_add_ilvl().val
 
-        if ilvl == 0:
-            style_name = "List Bullet"
-        elif ilvl < 4:
-            style_name = "List Bullet %s" % (ilvl + 1)
-        else:
-            style_name = "List Bullet 5"
-
-        if style_name not in d.styles:
-            continue
+        if min(ilvl, 4) not in list_styles:
+            return
 
         # numId = numPr.get_or_add_numId()
         # numPr.remove(numId)
         pPr.remove(numPr)
-        p.style = d.styles[style_name]
+        p.style = list_styles[min(ilvl, 4)]
 
-    d.save(ctx.docxfile)
+    return visit_paragraph
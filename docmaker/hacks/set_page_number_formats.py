@@ -1,6 +1,7 @@
 import sys
 
 from docx.oxml.shared import qn
+from docx.section import Section
 
 from docmaker.hooks import Hook
 from docmaker.oxml import OxmlElement
@@ -20,24 +21,22 @@ def set_page_number_format(section, pgNumStart=None, pgNumFmt=None):
                 pgNumType.set(qn("w:fmt"), pgNumFmt)
 
 
-@Hook("pre_save_docx")
+@Hook("pre_save_docx", visit=["w:sectPr"])
 def set_page_number_formats(ctx):
-    for section in ctx.composer.doc.sections[:-1]:
-        set_page_number_format(
-            section,
-            pgNumFmt="lowerRoman"
-        )
-
-    if hasattr(ctx, "coverpage_section"):
-        # Remove page number format for the coverpage section
-        set_page_number_format(
-            ctx.composer.doc.sections[1],
-            pgNumStart=1,
-            pgNumFmt="lowerRoman"
-        )
-
-    set_page_number_format(
-        ctx.composer.doc.sections[-1],
-        pgNumStart=1,
-        pgNumFmt="decimal"
-    )
+    sectPrs = [section._sectPr for section in ctx.composer.doc.sections]
+
+    # The coverpage section has no page number, so numbering restarts in the
+    # section following it
+    restart_numbering = sectPrs[1] if hasattr(ctx, "coverpage_section") else None
+
+    def visit_section(sectPr):
+        section = Section(sectPr, ctx.composer.doc.part)
+
+        if sectPr is sectPrs[-1]:
+            set_page_number_format(section, pgNumStart=1, pgNumFmt="decimal")
+        elif sectPr is restart_numbering:
+            set_page_number_format(section, pgNumStart=1, pgNumFmt="lowerRoman")
+        elif any(sectPr is _sectPr for _sectPr in sectPrs):
+            set_page_number_format(section, pgNumFmt="lowerRoman")
+
+    return visit_section
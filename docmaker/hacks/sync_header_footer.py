@@ -1,29 +1,39 @@
-from docx import Document
+from docx.section import Section
 
 from docmaker.hooks import Hook
 
 
-@Hook("pre_save_docx")
+@Hook("pre_save_docx", visit=["w:sectPr"])
 def sync_header_footer(ctx):
+    sections = ctx.composer.doc.sections
+    last_section = sections[-1]
+    sectPrs = [section._sectPr for section in sections[:-1]]
+
     # get the header reference from the last section
-    header = ctx.composer.doc.sections[-1].header
+    header = last_section.header
     headerReference = header._sectPr.get_headerReference(header._hdrftr_index)
 
     # get the footer reference from the last section
-    footer = ctx.composer.doc.sections[-1].footer
+    footer = last_section.footer
     footerReference = footer._sectPr.get_footerReference(footer._hdrftr_index)
 
     # add the references to the other sections
-    for section in ctx.composer.doc.sections[:-1]:
+    def visit_section(sectPr):
+        if not any(sectPr is _sectPr for _sectPr in sectPrs):
+            return
+
+        section = Section(sectPr, ctx.composer.doc.part)
         if headerReference is not None:
             section.header._sectPr.add_headerReference(
                 header._hdrftr_index,
                 headerReference.rId
             )
-        section.header_distance = ctx.composer.doc.sections[-1].header_distance
+        section.header_distance = last_section.header_distance
         if footerReference is not None:
             section.footer._sectPr.add_footerReference(
                 footer._hdrftr_index,
                 footerReference.rId
             )
-        section.footer_distance = ctx.composer.doc.sections[-1].footer_distance
+        section.footer_distance = last_section.footer_distance
+
+    return visit_section
@@ -1,12 +1,22 @@
-from docx import Document
+from docx.section import Section
 
 from docmaker.hooks import Hook
 
 
-@Hook("pre_save_docx")
+@Hook("pre_save_docx", visit=["w:sectPr"])
 def sync_margins(ctx):
-    for section in ctx.composer.doc.sections[:-1]:
-        section.top_margin = ctx.composer.doc.sections[-1].top_margin
-        section.bottom_margin = ctx.composer.doc.sections[-1].bottom_margin
-        section.left_margin = ctx.composer.doc.sections[-1].left_margin
-        section.right_margin = ctx.composer.doc.sections[-1].right_margin
+    sections = ctx.composer.doc.sections
+    last_section = sections[-1]
+    sectPrs = [section._sectPr for section in sections[:-1]]
+
+    def visit_section(sectPr):
+        if not any(sectPr is _sectPr for _sectPr in sectPrs):
+            return
+
+        section = Section(sectPr, ctx.composer.doc.part)
+        section.top_margin = last_section.top_margin
+        section.bottom_margin = last_section.bottom_margin
+        section.left_margin = last_section.left_margin
+        section.right_margin = last_section.right_margin
+
+    return visit_section
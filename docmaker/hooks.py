@@ -1,130 +1,222 @@
 import inspect
+import threading
 import time
 from collections.abc import Iterable
 from functools import partial, wraps
+from itertools import groupby
 
-from toposort import toposort_flatten
+from docx.oxml.ns import qn
+from toposort import toposort
 
-from .features import FeatureNotFound, load_feature
+from .concurrency import run_concurrently
+from .features import FeatureNotFound, load_feature, registry_version
 from .hacks import load_hacks
+from .oxml import walk_document
+from .spans import span
 
 
 class StopProcessing(Exception): pass
 
 
-def run_hooks(ctx, hook_name):
+class SkipToFinalize(Exception): pass
+
+
+def expand_depends(depends):
+    expanded = []
+
+    for depend in depends:
+        if "." not in depend:
+            try:
+                feature = load_feature(depend)
+            except FeatureNotFound:
+                # Assume it's a hack, and no action is required
+                expanded.append(depend)
+            else:
+                for (_, feature_method) in inspect.getmembers(feature, inspect.isfunction):
+                    expanded.append(feature_method.__qualname__)
+        else:
+            expanded.append(depend)
+
+    return expanded
+
+
+def compile_hook_plan(feature_classes, hook_name, disabled_hacks=()):
+    """Resolve and order everything that runs for hook_name
+
+    The plan refers to feature methods by their index in feature_classes and
+    attribute name, so it can be bound to any context with the same features.
+    """
     methods = {}
     plugins = {}
 
-    for feature in ctx.features:
-        for (_, _method) in inspect.getmembers(feature, inspect.ismethod):
-            if not callable(_method):
-                continue
+    candidates = []
+    for (idx, feature) in enumerate(feature_classes):
+        for (name, _method) in inspect.getmembers(feature, inspect.isfunction):
             if getattr(_method, "hook", None) != hook_name:
                 continue
-
-            qualname = _method.__qualname__
-            methods[qualname] = _method
-
-            if qualname not in plugins:
-                plugins[qualname] = list()
-
-            for depend in getattr(_method, "after", []):
-                if "." not in depend:
-                    try:
-                        _feature = load_feature(depend)
-                    except FeatureNotFound:
-                        # Assume it's a hack, and no action is required
-                        depends = [depend]
-                    else:
-                        depends = []
-                        for (_, feature_method) in inspect.getmembers(_feature, inspect.isfunction):
-                            depends.append(feature_method.__qualname__)
-                else:
-                    depends = [depend]
-
-                for _depend in depends:
-                    plugins[qualname].append(_depend)
-
-            for reverse_depend in getattr(_method, "before", []):
-                if "." not in reverse_depend:
-                    try:
-                        _feature = load_feature(reverse_depend)
-                    except FeatureNotFound:
-                        # Assume it's a hack, and no action is required
-                        reverse_depends = [reverse_depend]
-                    else:
-                        reverse_depends = []
-                        for (_, feature_method) in inspect.getmembers(_feature, inspect.isfunction):
-                            reverse_depends.append(feature_method.__qualname__)
-
-                else:
-                    reverse_depends = [reverse_depend]
-
-                for _reverse_depend in reverse_depends:
-                    if _reverse_depend not in plugins:
-                        plugins[_reverse_depend] = list()
-                    plugins[_reverse_depend].append(qualname)
+            candidates.append(((idx, name), _method))
 
     for _method in load_hacks(hook_name):
-        if ctx.get_as_boolean(f"hacks.disable_{_method.__name__}", False):
+        if _method.__name__ in disabled_hacks:
             continue
         if not callable(_method):
             continue
+        candidates.append(((None, _method), _method))
 
+    for (entry, _method) in candidates:
         qualname = _method.__qualname__
-        methods[qualname] = _method
+        methods[qualname] = (entry, _method)
 
         if qualname not in plugins:
             plugins[qualname] = list()
 
-        for depend in getattr(_method, "after", []):
-            if "." not in depend:
-                try:
-                    feature = load_feature(depend)
-                except FeatureNotFound:
-                    # Assume it's a hack, and no action is required
-                    depends = [depend]
-                else:
-                    depends = []
-                    for (_, feature_method) in inspect.getmembers(feature, inspect.isfunction):
-                        depends.append(feature_method.__qualname__)
-            else:
-                depends = [depend]
-
-            for _depend in depends:
-                plugins[qualname].append(_depend)
-
-        for reverse_depend in getattr(_method, "before", []):
-            if "." not in reverse_depend:
-                try:
-                    feature = load_feature(reverse_depend)
-                except FeatureNotFound:
-                    # Assume it's a hack, and no action is required
-                    reverse_depends = [reverse_depend]
-                else:
-                    reverse_depends = []
-                    for (_, feature_method) in inspect.getmembers(feature, inspect.isfunction):
-                        reverse_depends.append(feature_method.__qualname__)
+        for _depend in expand_depends(getattr(_method, "after", [])):
+            plugins[qualname].append(_depend)
 
-            else:
-                reverse_depends = [reverse_depend]
+        for _reverse_depend in expand_depends(getattr(_method, "before", [])):
+            if _reverse_depend not in plugins:
+                plugins[_reverse_depend] = list()
+            plugins[_reverse_depend].append(qualname)
+
+    plan = []
+
+    # Hooks are run in toposort order. Consecutive parallel safe hooks in the
+    # same level of the toposort don't depend on each other, so they're given
+    # the same batch number and can run at the same time. Visitors go last in
+    # their level, so that they're next to each other and share a walk.
+    for (level, qualnames) in enumerate(toposort({k: set(v) for (k, v) in plugins.items()})):
+        qualnames = [qualname for qualname in qualnames if qualname in methods]
+        for qualname in sorted(qualnames, key=lambda q: (bool(getattr(methods[q][1], "visit", None)), q)):
+
+            (entry, _method) = methods[qualname]
+
+            batch = None
+            if getattr(_method, "parallel_safe", False) and not getattr(_method, "visit", None):
+                batch = level
+
+            plan.append((*entry, batch))
+
+    return tuple(plan)
+
+
+__plans = {}
+__plans_lock = threading.Lock()
+
+
+def invalidate_hook_plans():
+    with __plans_lock:
+        __plans.clear()
+
+
+def get_hook_plan(ctx, hook_name):
+    feature_classes = tuple(type(feature) for feature in ctx.features)
+
+    # Hacks can be disabled per request, and that changes the graph
+    disabled_hacks = tuple(
+        _method.__name__ for _method in load_hacks(hook_name)
+        if ctx.get_as_boolean(f"hacks.disable_{_method.__name__}", False)
+    )
+
+    key = (feature_classes, hook_name, disabled_hacks, registry_version())
+
+    try:
+        return __plans[key]
+    except KeyError:
+        pass
+
+    plan = compile_hook_plan(feature_classes, hook_name, disabled_hacks)
+
+    with __plans_lock:
+        __plans[key] = plan
 
-            for _reverse_depend in reverse_depends:
-                if _reverse_depend not in plugins:
-                    plugins[_reverse_depend] = list()
-                plugins[_reverse_depend].append(qualname)
+    return plan
 
-    plugins = toposort_flatten({k: set(v) for (k, v) in plugins.items()})
-    plugins = filter(lambda m: m in methods, plugins)
-    plugins = map(methods.get, plugins)
-    plugins = list(plugins)
 
-    if not plugins:
+def bind_hook_plan(ctx, plan):
+    plugins = []
+    for (idx, _method, _) in plan:
+        if idx is not None:
+            _method = getattr(ctx.features[idx], _method)
+        plugins.append(_method)
+    return plugins
+
+
+def run_hooks(ctx, hook_name):
+    plan = get_hook_plan(ctx, hook_name)
+
+    if not plan:
         return
 
-    for _method in plugins:
-        _method(ctx)
+    with span(ctx, hook_name):
+        _run_hooks(ctx, hook_name, plan)
+
+
+def _run_hooks(ctx, hook_name, plan):
+    plugins = bind_hook_plan(ctx, plan)
+
+    batches = groupby(zip(plan, plugins), key=lambda item: item[0][2])
+
+    for (batch, items) in batches:
+        methods = [_method for (_, _method) in items]
+
+        if batch is not None and len(methods) > 1:
+            run_concurrently(methods, (ctx,), get_max_workers(ctx))
+            continue
+
+        # Methods that visit document elements share a single walk of the
+        # document with the visitors next to them in the plan. Anything
+        # planned in between runs between the walks, in order.
+        for (visit, group) in groupby(methods, key=lambda _method: bool(getattr(_method, "visit", None))):
+            if visit:
+                run_visitors(ctx, hook_name, list(group))
+                continue
+
+            for _method in group:
+                _method(ctx)
+
+
+def get_max_workers(ctx):
+    max_workers = ctx.get("pipeline.max_workers")
+    if max_workers is None:
+        return 4
+    return int(max_workers)
+
+
+def run_tasks(ctx, hook_name, *tasks):
+    """Run tasks, and the methods hooked to hook_name, concurrently
+
+    Each one starts as soon as everything in its `requires` has been set on ctx
+    by the others, according to their `provides`.
+    """
+    tasks = list(tasks) + bind_hook_plan(ctx, get_hook_plan(ctx, hook_name))
+
+    with span(ctx, f"tasks_{hook_name}") as record:
+        run_concurrently(tasks, (ctx,), get_max_workers(ctx))
+    ctx.timing[f"tasks_{hook_name}"] = round(record["duration"], 4)
+
+
+def run_visitors(ctx, hook_name, visitors):
+    callbacks = {}
+
+    for _method in visitors:
+        # Each visitor does its setup and returns the function to call for
+        # every matching element, or None if it has nothing to do
+        callback = _method(ctx)
+        if callback is None:
+            continue
+
+        for tag in _method.visit:
+            callbacks.setdefault(qn(tag), []).append(callback)
+
+    if not callbacks:
+        return
+
+    with span(ctx, f"visit_{hook_name}") as record:
+        for element in walk_document(ctx.docx, callbacks.keys()):
+            for callback in callbacks[element.tag]:
+                callback(element)
+    # A stage may walk the document more than once
+    ctx.timing[f"visit_{hook_name}"] = round(ctx.timing.get(f"visit_{hook_name}", 0) + record["duration"], 4)
 
 """
 @Hook
@@ -135,8 +227,21 @@ def foo(self, ctx):
 
 @Hook("pre_foo")
 def bar(self, ctx):
+
+@Hook("pre_foo", visit=["w:p"])
+def baz(self, ctx):
+    def visit_paragraph(p):
+        ...
+    return visit_paragraph
+
+@Hook("build_foo", requires=["bizz"], provides=["buzz"])
+def qux(self, ctx):
+
+@Hook("post_foo", parallel_safe=True)
+def quux(self, ctx):
 """
-def Hook(hook_name=None, /, before=None, after=None, predicate=None, ctx=None, **kwargs):
+def Hook(hook_name=None, /, before=None, after=None, predicate=None, ctx=None, visit=None,
+         requires=None, provides=None, parallel_safe=False, **kwargs):
     def wrapper(f):
         _predicate = predicate or (lambda _: True)
 
@@ -152,27 +257,37 @@ def Hook(hook_name=None, /, before=None, after=None, predicate=None, ctx=None, *
             else:
                 _ctx = args[-1]
 
-            for attr, value in kwargs.items():
-                if callable(value):
-                    value = value(_ctx)
-                setattr(_ctx, attr, value)
+            # The span covers the pre_ and post_ hooks too, which nest under
+            # it, while the timing entry is only for f itself
+            with span(_ctx, f.__qualname__) as record:
+                for attr, value in kwargs.items():
+                    if callable(value):
+                        value = value(_ctx)
+                    setattr(_ctx, attr, value)
+
+                run_hooks(_ctx, f"pre_{f.__name__}")
 
-            run_hooks(_ctx, f"pre_{f.__name__}")
+                if f.predicate:
+                    for p in f.predicate:
+                        if not p(_ctx):
+                            record["skipped"] = True
+                            return
 
-            if f.predicate:
-                for p in f.predicate:
-                    if not p(_ctx):
-                        return
+                start = time.perf_counter()
+                result = f(*args)
+                _ctx.timing[f.__name__] = round(time.perf_counter() - start, 4)
 
-            start = time.time()
-            f(*args)
-            _ctx.timing[f.__name__] = round(time.time() - start, 4)
+                run_hooks(_ctx, f"post_{f.__name__}")
 
-            run_hooks(_ctx, f"post_{f.__name__}")
+                return result
 
         call_with_hooks.hook = hook_name
         call_with_hooks.before = before or []
         call_with_hooks.after = after or []
+        call_with_hooks.visit = visit or []
+        call_with_hooks.requires = requires or []
+        call_with_hooks.provides = provides or []
+        call_with_hooks.parallel_safe = parallel_safe
 
         return call_with_hooks
 
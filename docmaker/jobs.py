@@ -0,0 +1,495 @@
+import fcntl
+import fnmatch
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from botocore.exceptions import ClientError
+
+from .concurrency import get_executor
+from .features.remote_files import RemoteFiles, get_session
+
+
+JOB_ID_RE = re.compile(r"^[0-9a-f]{32}$")
+
+FINISHED = ("done", "failed")
+
+# Jobs that are queued or running are marked as active, and the process they
+# were submitted to marks them again every HEARTBEAT_INTERVAL seconds. A job
+# that hasn't been marked for ORPHAN_TIMEOUT seconds was lost along with its
+# process, such as when uwsgi recycles a worker, and is failed.
+HEARTBEAT_INTERVAL = 30
+ORPHAN_TIMEOUT = 120
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobStore:
+    """Job status and results, kept in a directory shared by every worker
+
+    Each job is a directory holding `job.json` and, once it's done, `result`.
+    Jobs are removed once they're older than the TTL. Jobs that are queued or
+    running also have an empty file in `.active`, touched by the heartbeat.
+    """
+
+    def __init__(self, root, ttl=86400):
+        self.root = root
+        self.ttl = ttl
+
+        self._purged_at = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.join(self.root, ".active"), exist_ok=True)
+
+    def path(self, job_id, name=None):
+        if not JOB_ID_RE.match(job_id):
+            raise ValueError(f"Invalid job id: {job_id}")
+
+        if name is None:
+            return os.path.join(self.root, job_id)
+        return os.path.join(self.root, job_id, name)
+
+    def active_path(self, job_id):
+        if not JOB_ID_RE.match(job_id):
+            raise ValueError(f"Invalid job id: {job_id}")
+
+        return os.path.join(self.root, ".active", job_id)
+
+    @contextmanager
+    def _locked(self, job_id):
+        # The lock file is in the job's directory, and so this raises
+        # FileNotFoundError for a job that's been deleted
+        with self._lock, open(self.path(job_id, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
+
+    def _read(self, job_id):
+        try:
+            with open(self.path(job_id, "job.json"), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def _write(self, job_id, content):
+        os.makedirs(self.path(job_id), exist_ok=True)
+
+        fd, tmpfile = tempfile.mkstemp(dir=self.path(job_id), prefix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(content)
+        os.replace(tmpfile, self.path(job_id, "job.json"))
+
+    def _write_result(self, job_id, stream):
+        fd, tmpfile = tempfile.mkstemp(dir=self.path(job_id), prefix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            shutil.copyfileobj(stream, f)
+        os.replace(tmpfile, self.path(job_id, "result"))
+
+    def _open_result(self, job_id):
+        path = self.path(job_id, "result")
+        try:
+            return open(path, "rb"), os.stat(path).st_size
+        except FileNotFoundError:
+            return None, None
+
+    def _delete(self, job_id):
+        shutil.rmtree(self.path(job_id), ignore_errors=True)
+        self._clear_active(job_id)
+
+    def _job_ids(self):
+        return [job_id for job_id in os.listdir(self.root) if JOB_ID_RE.match(job_id)]
+
+    def _mark_active(self, job_id):
+        path = self.active_path(job_id)
+        with open(path, "a"):
+            pass
+        os.utime(path)
+
+    def _clear_active(self, job_id):
+        try:
+            os.unlink(self.active_path(job_id))
+        except FileNotFoundError:
+            pass
+
+    def _active(self):
+        """Return when each active job was last marked, by job id"""
+        active = {}
+        for job_id in os.listdir(os.path.join(self.root, ".active")):
+            try:
+                active[job_id] = os.stat(self.active_path(job_id)).st_mtime
+            except (FileNotFoundError, ValueError):
+                continue
+        return active
+
+    def _active_since(self, job_id):
+        try:
+            return os.stat(self.active_path(job_id)).st_mtime
+        except FileNotFoundError:
+            return None
+
+    def create(self, **fields):
+        job = dict(fields)
+        job["id"] = uuid.uuid4().hex
+        job["status"] = "queued"
+        job["created"] = time.time()
+        job["expires"] = job["created"] + self.ttl
+
+        self._write(job["id"], json.dumps(job).encode("utf-8"))
+        self._mark_active(job["id"])
+        return job
+
+    def load(self, job_id):
+        content = self._read(job_id)
+        if content is None:
+            return None
+
+        job = json.loads(content)
+        if job["expires"] < time.time():
+            self._delete(job_id)
+            return None
+
+        return job
+
+    def is_orphaned(self, job):
+        if job["status"] in FINISHED:
+            return False
+
+        since = self._active_since(job["id"])
+        return since is None or time.time() - since >= ORPHAN_TIMEOUT
+
+    def get(self, job_id):
+        job = self.load(job_id)
+
+        if job is not None and self.is_orphaned(job):
+            job = self.fail_orphan(job_id)
+
+        return job
+
+    def update(self, job_id, **fields):
+        try:
+            with self._locked(job_id):
+                job = self.load(job_id)
+                if job is None:
+                    return None
+
+                job.update(fields)
+                self._write(job_id, json.dumps(job).encode("utf-8"))
+        except FileNotFoundError:
+            # Deleted in the meantime
+            return None
+
+        if job["status"] in FINISHED:
+            self._clear_active(job_id)
+
+        return job
+
+    def fail_orphan(self, job_id):
+        try:
+            with self._locked(job_id):
+                # Check again, as the job may have finished since
+                job = self.load(job_id)
+                if job is None or not self.is_orphaned(job):
+                    return job
+
+                job.update(
+                    status="failed",
+                    finished=time.time(),
+                    error="The process running the job stopped before it finished",
+                )
+                self._write(job_id, json.dumps(job).encode("utf-8"))
+        except FileNotFoundError:
+            return None
+
+        self._clear_active(job_id)
+        return job
+
+    def heartbeat(self, job_ids):
+        for job_id in job_ids:
+            self._mark_active(job_id)
+
+    def count_active(self):
+        """Return how many jobs are queued or running, across every process"""
+        now = time.time()
+        return sum(1 for since in self._active().values() if now - since < ORPHAN_TIMEOUT)
+
+    def set_result(self, job_id, stream):
+        self._write_result(job_id, stream)
+
+    def open_result(self, job_id):
+        return self._open_result(job_id)
+
+    def delete(self, job_id):
+        self._delete(job_id)
+
+    def purge(self, interval=60):
+        # Checking every job on every request would be wasteful, so expired
+        # jobs are looked for at most once per interval
+        if time.time() - self._purged_at < interval:
+            return
+        self._purged_at = time.time()
+
+        for job_id in self._job_ids():
+            self.get(job_id)
+
+        # Jobs that finished or were deleted as the heartbeat marked them
+        for (job_id, since) in self._active().items():
+            if time.time() - since >= ORPHAN_TIMEOUT and self.get(job_id) is None:
+                self._clear_active(job_id)
+
+
+class S3JobStore(JobStore):
+    """A JobStore kept in an S3-compatible bucket, given as an s3:// URL
+
+    Expired jobs are removed when they're next read. A lifecycle rule on the
+    bucket is the best way to clean up jobs that never are. S3 has no locks, so
+    updates are only made one at a time within a process.
+    """
+
+    def __init__(self, url, ttl=86400):
+        # pylint: disable=super-init-not-called
+        self.root = url
+        self.ttl = ttl
+
+        self._purged_at = 0
+        self._lock = threading.Lock()
+
+        self.s3, self.bucket, self.prefix = RemoteFiles._get_s3_client(url)
+
+    def path(self, job_id, name=None):
+        if not JOB_ID_RE.match(job_id):
+            raise ValueError(f"Invalid job id: {job_id}")
+
+        return "/".join(filter(None, [self.prefix.rstrip("/"), job_id, name]))
+
+    def active_path(self, job_id):
+        if not JOB_ID_RE.match(job_id):
+            raise ValueError(f"Invalid job id: {job_id}")
+
+        return "/".join(filter(None, [self.prefix.rstrip("/"), ".active", job_id]))
+
+    @contextmanager
+    def _locked(self, job_id):
+        # pylint: disable=unused-argument
+        with self._lock:
+            yield
+
+    def _read(self, job_id):
+        try:
+            return self.s3.get_object(Bucket=self.bucket, Key=self.path(job_id, "job.json"))["Body"].read()
+        except self.s3.exceptions.NoSuchKey:
+            return None
+
+    def _write(self, job_id, content):
+        self.s3.put_object(Bucket=self.bucket, Key=self.path(job_id, "job.json"), Body=content)
+
+    def _write_result(self, job_id, stream):
+        self.s3.upload_fileobj(stream, self.bucket, self.path(job_id, "result"))
+
+    def _open_result(self, job_id):
+        try:
+            resp = self.s3.get_object(Bucket=self.bucket, Key=self.path(job_id, "result"))
+        except self.s3.exceptions.NoSuchKey:
+            return None, None
+        return resp["Body"], resp["ContentLength"]
+
+    def _delete(self, job_id):
+        self.s3.delete_objects(Bucket=self.bucket, Delete={"Objects": [
+            {"Key": self.path(job_id, "job.json")},
+            {"Key": self.path(job_id, "result")},
+            {"Key": self.active_path(job_id)},
+        ]})
+
+    def _mark_active(self, job_id):
+        self.s3.put_object(Bucket=self.bucket, Key=self.active_path(job_id), Body=b"")
+
+    def _clear_active(self, job_id):
+        self.s3.delete_object(Bucket=self.bucket, Key=self.active_path(job_id))
+
+    def _active(self):
+        prefix = "/".join(filter(None, [self.prefix.rstrip("/"), ".active"])) + "/"
+
+        active = {}
+        for page in self.s3.get_paginator("list_objects_v2").paginate(Bucket=self.bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                active[obj["Key"][len(prefix):]] = obj["LastModified"].timestamp()
+        return active
+
+    def _active_since(self, job_id):
+        try:
+            return self.s3.head_object(Bucket=self.bucket, Key=self.active_path(job_id))["LastModified"].timestamp()
+        except ClientError as e:
+            if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+                return None
+            raise
+
+    def purge(self, interval=60):
+        pass
+
+
+def get_job_store(location, ttl=86400):
+    if location.startswith("s3://"):
+        return S3JobStore(location, ttl)
+    return JobStore(location, ttl)
+
+
+class JobQueue:
+    """Runs jobs on a bounded pool of threads, refusing more than max_queued
+
+    max_queued is for every process sharing the store, as jobs that are queued
+    or running are counted there.
+    """
+
+    def __init__(self, store, max_workers=2, max_queued=100, webhook_timeout=10, webhook_hosts=()):
+        self.store = store
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.webhook_timeout = webhook_timeout
+        self.webhook_hosts = [host.lower() for host in webhook_hosts]
+
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+
+        # The jobs submitted to this process that haven't finished yet
+        self._jobs = set()
+        self._heartbeat = None
+
+    def allow_webhook(self, url):
+        """Whether jobs may POST to url when they finish"""
+        url = urlparse(url)
+        if url.scheme not in ("http", "https") or not url.hostname:
+            return False
+
+        return any(fnmatch.fnmatchcase(url.hostname.lower(), host) for host in self.webhook_hosts)
+
+    def submit(self, resource, request_factory, body, **fields):
+        """Queue a render of body by resource, returning the new job
+
+        request_factory is called with the spooled body in the worker thread,
+        and returns the (req, resp) pair the resource will be called with.
+        """
+        with self._lock:
+            self.queued += 1
+
+        try:
+            self.store.purge()
+            if self.store.count_active() >= self.max_queued:
+                raise QueueFull()
+
+            job = self.store.create(**fields)
+            with self._lock:
+                self._jobs.add(job["id"])
+            self.start_heartbeat()
+
+            get_executor(self.max_workers, "jobs").submit(
+                self.run, job, resource, request_factory, body
+            )
+        except BaseException:
+            with self._lock:
+                self.queued -= 1
+            raise
+
+        return job
+
+    def start_heartbeat(self):
+        with self._lock:
+            if self._heartbeat is not None:
+                return
+
+            self._heartbeat = threading.Thread(target=self.heartbeat, name="docmaker-jobs-heartbeat", daemon=True)
+            self._heartbeat.start()
+
+    def heartbeat(self):
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+
+            with self._lock:
+                job_ids = list(self._jobs)
+
+            try:
+                self.store.heartbeat(job_ids)
+            except Exception:  # pylint: disable=broad-except
+                traceback.print_exc()
+
+    def run(self, job, resource, request_factory, body):
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+
+        job_id = job["id"]
+        req = None
+        try:
+            self.store.update(job_id, status="running", started=time.time())
+
+            req, resp = request_factory(body)
+            resource((req, resp))
+
+            try:
+                self.store.set_result(job_id, resp.stream)
+            finally:
+                resp.stream.close()
+
+            m = re.search(r"filename=(.+)", resp.get_header("content-disposition") or "")
+
+            job = self.store.update(
+                job_id,
+                status="done",
+                finished=time.time(),
+                filename=m.groups()[0] if m else None,
+                timing=req.context.timing,
+                spans=req.context.spans,
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            with self._lock:
+                self.failed += 1
+
+            job = self.store.update(
+                job_id,
+                status="failed",
+                finished=time.time(),
+                error=str(e),
+                traceback=traceback.format_exc(),
+            )
+        else:
+            with self._lock:
+                self.completed += 1
+        finally:
+            with self._lock:
+                self.running -= 1
+                self._jobs.discard(job_id)
+            if req is not None:
+                req.stream.close()
+            os.unlink(body)
+
+        if job is not None and job.get("webhook"):
+            self.notify(job)
+
+    def notify(self, job):
+        try:
+            # A redirect could lead anywhere, so it isn't followed
+            r = get_session().post(job["webhook"], json=job, timeout=self.webhook_timeout, allow_redirects=False)
+            self.store.update(job["id"], webhook_status=r.status_code)
+        except Exception as e:  # pylint: disable=broad-except
+            self.store.update(job["id"], webhook_status=str(e))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queued": self.queued,
+                "running": self.running,
+                "completed": self.completed,
+                "failed": self.failed,
+                "max_workers": self.max_workers,
+                "max_queued": self.max_queued,
+            }
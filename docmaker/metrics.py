@@ -0,0 +1,325 @@
+import fcntl
+import glob
+import json
+import math
+import os
+import tempfile
+import threading
+
+
+# Suited to document renders, which take from a fraction of a second to
+# minutes for a large PDF
+DEFAULT_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+
+def format_value(value):
+    if math.isnan(value):
+        return "NaN"
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    pairs = []
+    for (name, value) in labels:
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {', '.join(self.labelnames)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def add(self, key, value):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def values(self):
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self):
+        for (key, value) in sorted(self.values().items()):
+            yield (self.name, list(zip(self.labelnames, key)), value)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for (name, labels, value) in self.samples():
+            lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    type = "counter"
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0, 0]
+            (counts, _, _) = entry = self._values[key]
+
+            for (idx, bound) in enumerate(self.buckets):
+                if value <= bound:
+                    counts[idx] += 1
+                    break
+
+            entry[1] += value
+            entry[2] += 1
+
+    def add(self, key, value):
+        (counts, total, count) = value
+        with self._lock:
+            if key not in self._values:
+                self._values[key] = [[0] * len(self.buckets), 0, 0]
+            entry = self._values[key]
+
+            for (idx, bucket_count) in enumerate(counts):
+                entry[0][idx] += bucket_count
+            entry[1] += total
+            entry[2] += count
+
+    def values(self):
+        with self._lock:
+            return {key: [list(counts), total, count] for (key, (counts, total, count)) in self._values.items()}
+
+    def samples(self):
+        for (key, (counts, total, count)) in sorted(self.values().items()):
+            labels = list(zip(self.labelnames, key))
+
+            cumulative = 0
+            for (bound, bucket_count) in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield (f"{self.name}_bucket", labels + [("le", format_value(bound))], cumulative)
+
+            yield (f"{self.name}_sum", labels, total)
+            yield (f"{self.name}_count", labels, count)
+
+
+__metrics = {}
+__collectors = []
+__metrics_lock = threading.Lock()
+
+# Set when metrics are shared between processes
+__shared_dir = None
+
+
+def register(metric):
+    """Add metric to the registry, returning the one already there by that name"""
+    with __metrics_lock:
+        return __metrics.setdefault(metric.name, metric)
+
+
+def counter(name, documentation, labelnames=()):
+    return register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return register(Histogram(name, documentation, labelnames, buckets))
+
+
+def add_collector(collector):
+    """Call collector before each scrape, to set metrics that are read from elsewhere"""
+    with __metrics_lock:
+        if collector not in __collectors:
+            __collectors.append(collector)
+
+
+def share(directory):
+    """Share metrics between every process that writes them to directory
+
+    Each process writes its metrics to a file of its own, and a scrape of any
+    of them adds up the counters and histograms of all of them, including
+    those that have since exited. Gauges are labelled with the `pid` they came
+    from, and dropped once it exits. The directory should be new or emptied
+    each time the service starts.
+    """
+    global __shared_dir
+
+    os.makedirs(directory, exist_ok=True)
+    __shared_dir = directory
+
+
+def collect():
+    with __metrics_lock:
+        collectors = list(__collectors)
+        metrics = list(__metrics.values())
+
+    for collector in collectors:
+        collector()
+
+    return metrics
+
+
+def snapshot(metrics):
+    return {
+        metric.name: {
+            "type": metric.type,
+            "documentation": metric.documentation,
+            "labelnames": metric.labelnames,
+            "buckets": metric.buckets[:-1] if metric.type == "histogram" else None,
+            "values": [[key, value] for (key, value) in metric.values().items()],
+        }
+        for metric in metrics
+    }
+
+
+def write_snapshot(metrics, filename):
+    fd, tmpfile = tempfile.mkstemp(dir=__shared_dir, prefix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(snapshot(metrics), f)
+    os.replace(tmpfile, os.path.join(__shared_dir, filename))
+
+
+def flush():
+    """Write this process's metrics for the others to read, if they're shared"""
+    if __shared_dir is None:
+        return
+
+    write_snapshot(collect(), f"{os.getpid()}.json")
+
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def merge(snapshots):
+    """Combine the snapshots of several processes, given as (pid, snapshot)"""
+    merged = {}
+
+    for (pid, data) in snapshots:
+        for (name, entry) in data.items():
+            gauge = entry["type"] == "gauge"
+            if gauge and pid is None:
+                continue
+
+            metric = merged.get(name)
+            if metric is None:
+                labelnames = list(entry["labelnames"]) + (["pid"] if gauge else [])
+                if entry["type"] == "histogram":
+                    metric = Histogram(name, entry["documentation"], labelnames, entry["buckets"])
+                else:
+                    metric = {"counter": Counter, "gauge": Gauge}[entry["type"]](
+                        name, entry["documentation"], labelnames
+                    )
+                merged[name] = metric
+
+            for (key, value) in entry["values"]:
+                if gauge:
+                    metric.set(value, **dict(zip(metric.labelnames, key + [pid])))
+                else:
+                    metric.add(tuple(key), value)
+
+    return list(merged.values())
+
+
+def load_shared(metrics):
+    """Return the metrics of every process sharing them, this one included"""
+    write_snapshot(metrics, f"{os.getpid()}.json")
+
+    with open(os.path.join(__shared_dir, ".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+
+        snapshots = []
+        dead = []
+        # This process's own metrics go first, so they're listed in the order
+        # they were registered
+        own = os.path.join(__shared_dir, f"{os.getpid()}.json")
+        for path in sorted(glob.glob(os.path.join(__shared_dir, "*.json")), key=lambda path: path != own):
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+            except (FileNotFoundError, ValueError):
+                continue
+
+            name = os.path.basename(path)[:-len(".json")]
+            if not name.isdigit():
+                # What's left of processes that have exited
+                snapshots.append((None, data))
+            elif pid_exists(int(name)):
+                snapshots.append((int(name), data))
+            else:
+                snapshots.append((None, data))
+                dead.append(path)
+
+        if dead:
+            # The counters of exited processes are added up into one file, so
+            # that there's no more to read for each one that exits
+            write_snapshot(merge(entry for entry in snapshots if entry[0] is None), "exited.json")
+            for path in dead:
+                os.unlink(path)
+
+    return merge(snapshots)
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format"""
+    metrics = collect()
+
+    if __shared_dir is not None:
+        metrics = load_shared(metrics)
+
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
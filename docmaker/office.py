@@ -0,0 +1,285 @@
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+
+try:
+    import uno
+    from com.sun.star.beans import PropertyValue
+    from com.sun.star.connection import NoConnectException
+    from com.sun.star.uno import RuntimeException as UnoRuntimeException
+except ImportError:
+    uno = None
+
+from .pool import CircuitBreaker, Worker, WorkerPool, get_pool
+
+
+# LibreOffice export filters for the output formats we can convert to over the
+# bridge. Anything else is handed to the unoconv binary.
+EXPORT_FILTERS = {
+    "doc": "MS Word 97",
+    "html": "HTML (StarWriter)",
+    "odt": "writer8",
+    "pdf": "writer_pdf_Export",
+    "rtf": "Rich Text Format",
+    "txt": "Text",
+}
+
+# com.sun.star.document.UpdateDocMode.QUIET_UPDATE
+QUIET_UPDATE = 1
+
+
+def bridge_available():
+    return uno is not None
+
+
+def make_properties(**kwargs):
+    props = []
+    for (name, value) in kwargs.items():
+        prop = PropertyValue()
+        prop.Name = name
+        prop.Value = value
+        props.append(prop)
+    return tuple(props)
+
+
+class UnoBridge:
+    """A long-lived connection to a LibreOffice listener (e.g. `unoconv -l`)"""
+
+    def __init__(self, host="127.0.0.1", port=2002):
+        self.host = host
+        self.port = int(port)
+
+        self._desktop = None
+        self._lock = threading.Lock()
+
+    @property
+    def connection_string(self):
+        return f"uno:socket,host={self.host},port={self.port};urp;StarOffice.ComponentContext"
+
+    @property
+    def connected(self):
+        return self._desktop is not None
+
+    def connect(self):
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver",
+            local_context
+        )
+
+        context = resolver.resolve(self.connection_string)
+
+        self._desktop = context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.frame.Desktop",
+            context
+        )
+
+    def disconnect(self):
+        self._desktop = None
+
+    def convert(self, infile, outfile, output_format="pdf", retries=3):
+        if output_format not in EXPORT_FILTERS:
+            raise ValueError(f"{output_format} is not supported by the uno bridge")
+
+        with self._lock:
+            tries = 0
+            while True:
+                try:
+                    if not self.connected:
+                        self.connect()
+
+                    return self._convert(infile, outfile, output_format)
+                except (NoConnectException, UnoRuntimeException):
+                    # The listener went away (or was restarted underneath us),
+                    # drop the stale bridge and reconnect on the next attempt
+                    self.disconnect()
+
+                    tries += 1
+                    if tries >= retries:
+                        raise
+
+    def _convert(self, infile, outfile, output_format):
+        document = self._desktop.loadComponentFromURL(
+            uno.systemPathToFileUrl(os.path.abspath(infile)),
+            "_blank",
+            0,
+            make_properties(Hidden=True, ReadOnly=True, UpdateDocMode=QUIET_UPDATE)
+        )
+
+        try:
+            self.update_indexes(document)
+
+            document.storeToURL(
+                uno.systemPathToFileUrl(os.path.abspath(outfile)),
+                make_properties(FilterName=EXPORT_FILTERS[output_format])
+            )
+        finally:
+            document.close(True)
+
+        return outfile
+
+    @staticmethod
+    def update_indexes(document):
+        # Same as unoconv: the first pass builds the table of contents, which
+        # may push content onto new pages, the second fixes the page numbers
+        if not hasattr(document, "getDocumentIndexes"):
+            return
+
+        for _ in range(2):
+            document.refresh()
+            indexes = document.getDocumentIndexes()
+            for i in range(indexes.getCount()):
+                indexes.getByIndex(i).update()
+
+
+class OfficeInstance(Worker):
+    """A soffice process, with its own port and user profile, owned by a pool"""
+
+    def __init__(self, soffice, host="127.0.0.1", startup_timeout=30, convert_timeout=120):
+        super().__init__()
+
+        self.soffice = soffice
+        self.host = host
+        self.startup_timeout = startup_timeout
+        self.convert_timeout = convert_timeout
+
+        self.port = None
+        self.process = None
+        self.bridge = None
+        # The profile is kept across restarts, creating it is most of the
+        # startup cost of a fresh soffice
+        self.profile_dir = tempfile.mkdtemp(prefix="docmaker-soffice-")
+
+    @staticmethod
+    def find_free_port(host):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind((host, 0))
+            return s.getsockname()[1]
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        self.port = self.find_free_port(self.host)
+
+        self.process = subprocess.Popen(
+            [
+                self.soffice,
+                "--headless",
+                "--invisible",
+                "--nocrashreport",
+                "--nodefault",
+                "--nologo",
+                "--nofirststartwizard",
+                "--norestore",
+                f"-env:UserInstallation={uno.systemPathToFileUrl(self.profile_dir)}",
+                f"--accept=socket,host={self.host},port={self.port};urp;StarOffice.ComponentContext",
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+        self.bridge = UnoBridge(self.host, self.port)
+
+        deadline = time.monotonic() + self.startup_timeout
+        while True:
+            if not self.alive:
+                raise RuntimeError(f"soffice exited with status {self.process.returncode}")
+
+            try:
+                self.bridge.connect()
+            except NoConnectException:
+                if time.monotonic() > deadline:
+                    self.kill()
+                    raise RuntimeError(f"soffice did not start listening on port {self.port}")
+                time.sleep(0.25)
+            else:
+                break
+
+    def kill(self):
+        if self.alive:
+            self.process.kill()
+
+    def stop(self):
+        if self.bridge is not None:
+            self.bridge.disconnect()
+
+        if self.alive:
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def cleanup(self):
+        self.stop()
+        shutil.rmtree(self.profile_dir, ignore_errors=True)
+
+    def convert(self, infile, outfile, output_format="pdf"):
+        # There's no way to interrupt a call over the bridge, so a hung
+        # conversion is dealt with by killing soffice, which the pool then
+        # notices and restarts
+        watchdog = threading.Timer(self.convert_timeout, self.kill)
+        watchdog.daemon = True
+        watchdog.start()
+
+        try:
+            return self.bridge.convert(infile, outfile, output_format, retries=1)
+        finally:
+            watchdog.cancel()
+
+    def stats(self):
+        stats = super().stats()
+        stats["port"] = self.port
+        return stats
+
+
+class OfficePool(WorkerPool):
+    def stop(self):
+        with self._cond:
+            workers, self.workers = self.workers, []
+
+        for worker in workers:
+            worker.cleanup()
+
+
+def get_office_pool(size, soffice=None, startup_timeout=30, convert_timeout=120,
+                    lease_timeout=None, failure_threshold=5, reset_timeout=30):
+    soffice = soffice or shutil.which("soffice") or shutil.which("libreoffice")
+
+    def create():
+        return OfficePool(
+            lambda: OfficeInstance(soffice, startup_timeout=startup_timeout,
+                                   convert_timeout=convert_timeout),
+            size=size,
+            lease_timeout=lease_timeout,
+            breaker=CircuitBreaker(failure_threshold, reset_timeout)
+        )
+
+    # Routes with different settings each get a pool of their own
+    return get_pool(
+        f"office[{size}]({soffice}, {startup_timeout}, {convert_timeout}, {lease_timeout}, "
+        f"{failure_threshold}, {reset_timeout})",
+        create
+    )
+
+
+__bridges = {}
+__bridges_lock = threading.Lock()
+
+
+def get_bridge(host="127.0.0.1", port=2002):
+    # Bridges are created lazily, so each uwsgi worker gets its own connection
+    # after the fork rather than sharing one socket
+    key = (host, int(port))
+
+    with __bridges_lock:
+        if key not in __bridges:
+            __bridges[key] = UnoBridge(host, port)
+        return __bridges[key]
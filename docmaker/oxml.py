@@ -1,5 +1,8 @@
+import copy
+import threading
 from contextlib import contextmanager
 
+from docx import Document
 from docx.oxml.shared import OxmlElement as _OxmlElement
 
 
@@ -13,3 +16,34 @@ def OxmlElement(nsptag_str, attrs=None, nsdecls=None, append_to=None, next_to=No
         append_to.append(_element)
     if next_to is not None:
         next_to.addnext(_element)
+
+
+def walk_document(doc, tags):
+    """Yield every element with one of the (clark notation) tags in doc
+
+    Both the main document part and the styles part are walked. The matches are
+    collected up front, so callers are free to modify the tree as they go.
+    """
+    tags = tuple(tags)
+
+    for root in (doc.element, doc.styles.element):
+        yield from list(root.iter(*tags))
+
+
+__prototype = None
+__prototype_lock = threading.Lock()
+
+
+def new_document():
+    """Return a blank document, as from `Document()`
+
+    The default template is only unzipped and parsed once per process, every
+    document after that is a copy of the parsed prototype.
+    """
+    global __prototype
+
+    with __prototype_lock:
+        if __prototype is None:
+            __prototype = Document()
+
+    return copy.deepcopy(__prototype)
@@ -0,0 +1,446 @@
+import base64
+import os
+import re
+import socket
+import subprocess
+import tempfile
+import time
+import urllib.parse
+from functools import partial
+
+import pypandoc
+import requests
+from pypandoc import get_pandoc_formats, get_pandoc_path, normalize_format
+
+from .pool import CircuitBreaker, Worker, WorkerFailed, WorkerPool, get_pool
+from .spans import span
+
+
+class PypandocBackend:
+    """Runs a fresh pandoc process for every conversion"""
+
+    @staticmethod
+    def _convert(func, source, outputfile, **kwargs):
+        if outputfile is not None:
+            return func(source, outputfile=outputfile, **kwargs)
+
+        # Binary formats can't be written to stdout, so let pandoc write a
+        # scratch file and hand back its contents
+        with tempfile.TemporaryDirectory() as tmpdir:
+            outputfile = os.path.join(tmpdir, f"output.{kwargs.get('to')}")
+            func(source, outputfile=outputfile, **kwargs)
+
+            with open(outputfile, "rb") as f:
+                return f.read()
+
+    @staticmethod
+    def _run_pandoc(source, to, format=None, extra_args=(), encoding="utf-8", outputfile=None,
+                    filters=None, verify_format=True, sandbox=False, cworkdir=None, sort_files=True,
+                    text=False):
+        """Run pandoc as pypandoc would, taking the same arguments
+
+        pypandoc handles cworkdir by changing the working directory of the whole
+        process while it starts pandoc, which races with conversions running on
+        other threads, and can leave the process in a tmpdir that has since been
+        removed. Here pandoc is given a working directory of its own instead.
+        """
+        # pylint: disable=redefined-builtin,unused-argument
+        format = normalize_format(format) if format else None
+        to = normalize_format(to)
+
+        if verify_format:
+            from_formats, to_formats = get_pandoc_formats()
+            if format and re.split(r"\+|-", format)[0] not in from_formats:
+                raise RuntimeError(f"Invalid input format! Got \"{format}\" but expected one of these: "
+                                   f"{', '.join(from_formats)}")
+            if re.split(r"\+|-", to)[0] not in to_formats and to != "pdf":
+                raise RuntimeError(f"Invalid output format! Got {to} but expected one of these: "
+                                   f"{', '.join(to_formats)}")
+
+        args = [get_pandoc_path()]
+        if format:
+            args.append(f"--from={format}")
+        args.append(f"--to={to}")
+        if not text:
+            args.append(str(source))
+        if outputfile:
+            args.append(f"--output={outputfile}")
+        if sandbox:
+            args.append("--sandbox")
+        args.extend(extra_args or [])
+
+        if isinstance(filters, str):
+            filters = filters.split()
+        for _filter in filters or []:
+            args.append(f"--lua-filter={_filter}" if _filter.endswith(".lua") else f"--filter={_filter}")
+
+        p = subprocess.run(
+            args,
+            input=source.encode(encoding) if text else None,
+            cwd=cworkdir,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            check=False,
+        )
+        if p.returncode != 0:
+            raise RuntimeError(
+                f"Pandoc died with exitcode \"{p.returncode}\" during conversion: "
+                f"{p.stderr.decode(encoding, errors='replace')}"
+            )
+
+        if outputfile:
+            return ""
+        return p.stdout.decode(encoding, errors="replace")
+
+    def convert_file(self, source_file, outputfile, **kwargs):
+        if kwargs.get("cworkdir") is not None:
+            func = self._run_pandoc
+        else:
+            func = pypandoc.convert_file
+
+        return self._convert(func, source_file, outputfile, **kwargs)
+
+    def convert_text(self, source, outputfile, **kwargs):
+        if isinstance(source, bytes):
+            source = source.decode("utf-8")
+
+        if kwargs.get("cworkdir") is not None:
+            func = partial(self._run_pandoc, text=True)
+        else:
+            func = pypandoc.convert_text
+
+        return self._convert(func, source, outputfile, **kwargs)
+
+
+# Files over this size are assumed not to be resources of the document
+MAX_RESOURCE_SIZE = 32 * 1024 * 1024
+
+# Links and images in markdown, html and rst, which may be local files that
+# pandoc reads relative to its working directory
+LINK_RE = re.compile(
+    r"""\]\(\s*<?([^)\s>]+)"""
+    r"""|\bsrc=["']([^"']+)["']"""
+    r"""|^\s*\[[^\]]+\]:\s*<?([^\s>]+)"""
+    r"""|^\.\. (?:image|figure)::\s*(\S+)""",
+    re.MULTILINE
+)
+
+
+def find_links(text):
+    """Return the relative or absolute local paths that text links to"""
+    links = []
+    for match in LINK_RE.finditer(text):
+        link = next(group for group in match.groups() if group)
+        if "://" in link or link.startswith(("data:", "mailto:", "#")):
+            continue
+
+        link = urllib.parse.unquote(link.split("#", 1)[0])
+        if link and link not in links:
+            links.append(link)
+
+    return links
+
+
+def get_document_inputs(document, options):
+    """Return the local files a document depends on"""
+    inputs = {os.path.abspath(document["srcfile"])}
+
+    for value in list(options.values()) + list(document["options"].values()):
+        if isinstance(value, str) and os.path.isfile(value):
+            inputs.add(os.path.abspath(value))
+
+    try:
+        with open(document["srcfile"], "r") as f:
+            text = f.read()
+    except (OSError, UnicodeDecodeError):
+        return inputs
+
+    basedir = os.path.dirname(os.path.abspath(document["srcfile"]))
+    for link in find_links(text):
+        path = os.path.join(basedir, link)
+        if os.path.isfile(path):
+            inputs.add(os.path.abspath(path))
+
+    return inputs
+
+
+def read_file_b64(path):
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode("ascii")
+
+
+def extra_args_to_options(extra_args):
+    """Translate pandoc command line arguments to pandoc server options
+
+    Files referenced by `--reference-doc` are sent along with the request, since
+    the server cannot read them from our filesystem.
+    """
+    options = {}
+    files = {}
+
+    for arg in extra_args or []:
+        if not arg.startswith("--"):
+            raise ValueError(f"{arg} is not supported by the pandoc server backend")
+
+        if "=" in arg:
+            name, value = arg[2:].split("=", 1)
+        else:
+            name, value = arg[2:], True
+
+        if name in ("variable", "metadata"):
+            if ":" in value:
+                key, value = value.split(":", 1)
+            elif "=" in value:
+                key, value = value.split("=", 1)
+            else:
+                key, value = value, True
+            name = {"variable": "variables"}.get(name, name)
+            options.setdefault(name, {})[key] = value
+        elif name == "reference-doc":
+            filename = f"reference{os.path.splitext(value)[1]}"
+            files[filename] = read_file_b64(value)
+            options[name] = filename
+        else:
+            options[name] = value
+
+    return options, files
+
+
+class PandocServer(Worker):
+    """A `pandoc server` process owned by a pool"""
+
+    def __init__(self, pandoc=None, host="127.0.0.1", timeout=120, startup_timeout=10):
+        super().__init__()
+
+        self.pandoc = pandoc
+        self.host = host
+        self.timeout = timeout
+        self.startup_timeout = startup_timeout
+
+        self.port = None
+        self.process = None
+        self.session = requests.Session()
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}/"
+
+    @property
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def start(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.bind((self.host, 0))
+            self.port = s.getsockname()[1]
+
+        self.process = subprocess.Popen(
+            [
+                self.pandoc or get_pandoc_path(),
+                "server",
+                "--port", str(self.port),
+                "--timeout", str(self.timeout),
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+
+        deadline = time.monotonic() + self.startup_timeout
+        while True:
+            if not self.alive:
+                raise RuntimeError(f"pandoc server exited with status {self.process.returncode}")
+
+            try:
+                socket.create_connection((self.host, self.port), timeout=1).close()
+            except OSError:
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError(f"pandoc server did not start listening on port {self.port}")
+                time.sleep(0.1)
+            else:
+                break
+
+    def stop(self):
+        if self.alive:
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+
+    def post(self, payload):
+        r = self.session.post(
+            self.url,
+            json=payload,
+            headers={"accept": "application/octet-stream"},
+            timeout=self.timeout + 5,
+        )
+        r.raise_for_status()
+        return r.content
+
+
+class RemotePandocServer(PandocServer):
+    """A `pandoc server` we don't manage, e.g. a separate container"""
+
+    def __init__(self, url, timeout=120):
+        super().__init__(timeout=timeout)
+        self._url = url
+
+    @property
+    def url(self):
+        return self._url
+
+    @property
+    def alive(self):
+        return True
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+
+class PandocServerBackend:
+    def __init__(self, pool, retries=3, resource_dir=None):
+        self.pool = pool
+        self.retries = retries
+        self.resource_dir = resource_dir
+
+    def get_resource_files(self, source, cworkdir):
+        # Images and other resources are read relative to the working
+        # directory, so the files the document links to are sent along. In the
+        # API, or with a resource_dir, only files within that directory are.
+        resource_dir = self.resource_dir or cworkdir
+        confine = resource_dir is not None
+
+        resource_dir = os.path.realpath(resource_dir or os.getcwd())
+
+        files = {}
+        for link in find_links(source):
+            path = os.path.realpath(os.path.join(resource_dir, link))
+            if confine and os.path.commonpath([resource_dir, path]) != resource_dir:
+                continue
+            if not os.path.isfile(path) or os.path.getsize(path) > MAX_RESOURCE_SIZE:
+                continue
+            files[link] = read_file_b64(path)
+
+        return files
+
+    def convert_text(self, source, outputfile, format=None, to=None, extra_args=None,
+                     cworkdir=None, **kwargs):
+        # pylint: disable=redefined-builtin,unused-argument
+        if isinstance(source, bytes):
+            source = source.decode("utf-8")
+
+        options, files = extra_args_to_options(extra_args)
+
+        # The server, unlike the pandoc command line, doesn't accept aliases
+        # such as "md"
+        payload = {
+            "text": source,
+            "to": normalize_format(to),
+            "files": {**self.get_resource_files(source, cworkdir), **files},
+            **options,
+        }
+        if format:
+            payload["from"] = normalize_format(format)
+
+        tries = 0
+        while True:
+            try:
+                with self.pool.lease() as server:
+                    contents = server.post(payload)
+            except (WorkerFailed, requests.ConnectionError):
+                tries += 1
+                if tries >= self.retries:
+                    raise
+            else:
+                break
+
+        if outputfile is None:
+            return contents
+
+        with open(outputfile, "wb") as f:
+            f.write(contents)
+
+        return outputfile
+
+    def convert_file(self, source_file, outputfile, cworkdir=None, **kwargs):
+        if cworkdir and not os.path.isabs(source_file):
+            source_file = os.path.join(cworkdir, source_file)
+
+        with open(source_file, "rb") as f:
+            source = f.read()
+
+        return self.convert_text(source, outputfile, cworkdir=cworkdir, **kwargs)
+
+
+def get_pandoc_server_pool(size=1, urls=None, timeout=120, failure_threshold=5, reset_timeout=30):
+    if urls:
+        def create():
+            servers = iter(urls)
+            return WorkerPool(
+                lambda: RemotePandocServer(next(servers), timeout=timeout),
+                size=len(urls),
+                max_concurrency=4,
+                breaker=CircuitBreaker(failure_threshold, reset_timeout)
+            )
+
+        return get_pool(f"pandoc[{','.join(urls)}]({timeout}, {failure_threshold}, {reset_timeout})", create)
+
+    def create():
+        return WorkerPool(
+            lambda: PandocServer(timeout=timeout),
+            size=size,
+            max_concurrency=4,
+            breaker=CircuitBreaker(failure_threshold, reset_timeout)
+        )
+
+    # Routes with different settings each get a pool of their own
+    return get_pool(f"pandoc[{size}]({timeout}, {failure_threshold}, {reset_timeout})", create)
+
+
+def get_backend(ctx):
+    backend = (ctx.get("pandoc.backend") if ctx else None) or "pypandoc"
+
+    if backend == "pypandoc":
+        return PypandocBackend()
+
+    if backend == "server":
+        urls = ctx.get("pandoc.server.url")
+        if urls and not isinstance(urls, list):
+            urls = [urls]
+
+        pool = get_pandoc_server_pool(
+            size=int(ctx.get("pandoc.server.pool_size") or 1),
+            urls=urls,
+            timeout=int(ctx.get("pandoc.server.timeout") or 120),
+            failure_threshold=int(ctx.get("pandoc.server.failure_threshold") or 5),
+            reset_timeout=float(ctx.get("pandoc.server.reset_timeout") or 30),
+        )
+
+        return PandocServerBackend(
+            pool,
+            retries=int(ctx.get("pandoc.server.retries") or 3),
+            resource_dir=ctx.get("pandoc.server.resource_dir"),
+        )
+
+    raise ValueError(f"Unknown pandoc backend: {backend}")
+
+
+def convert_file(ctx, source_file, outputfile, **kwargs):
+    if ctx is None:
+        return get_backend(ctx).convert_file(source_file, outputfile, **kwargs)
+
+    with span(ctx, "pandoc.convert_file"):
+        return get_backend(ctx).convert_file(source_file, outputfile, **kwargs)
+
+
+def convert_text(ctx, source, outputfile, **kwargs):
+    if ctx is None:
+        return get_backend(ctx).convert_text(source, outputfile, **kwargs)
+
+    with span(ctx, "pandoc.convert_text"):
+        return get_backend(ctx).convert_text(source, outputfile, **kwargs)
@@ -0,0 +1,262 @@
+import atexit
+import threading
+import time
+from contextlib import contextmanager
+
+
+class PoolUnavailable(Exception):
+    pass
+
+
+class WorkerFailed(Exception):
+    pass
+
+
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.failures = 0
+        self.opened_at = None
+        self.probe_started = None
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def allow(self):
+        # A half-open breaker lets a single request through as a probe; its
+        # failure will re-open the breaker, its success will close it. A probe
+        # that never reports back is given up on after reset_timeout.
+        with self._lock:
+            state = self.state
+            if state == self.CLOSED:
+                return True
+            if state == self.OPEN:
+                return False
+
+            now = time.monotonic()
+            if self.probe_started is not None and now - self.probe_started < self.reset_timeout:
+                return False
+            self.probe_started = now
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self.probe_started = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self.probe_started = None
+            if self.failures >= self.failure_threshold or self.opened_at is not None:
+                self.opened_at = time.monotonic()
+
+
+class Worker:
+    """Base class for a long-running helper process managed by a WorkerPool"""
+
+    def __init__(self):
+        self.busy = 0
+        self.completed = 0
+        self.failures = 0
+        self.restarts = 0
+        self.restarting = False
+        self.last_error = None
+
+    def start(self):
+        raise NotImplementedError
+
+    def stop(self):
+        raise NotImplementedError
+
+    @property
+    def alive(self):
+        raise NotImplementedError
+
+    def restart(self):
+        self.stop()
+        self.restarts += 1
+        self.start()
+
+    def stats(self):
+        return {
+            "alive": self.alive,
+            "busy": self.busy,
+            "completed": self.completed,
+            "failures": self.failures,
+            "restarts": self.restarts,
+            "last_error": self.last_error,
+        }
+
+
+class WorkerPool:
+    def __init__(self, factory, size=1, max_concurrency=1, lease_timeout=None, breaker=None):
+        self.factory = factory
+        self.size = size
+        self.max_concurrency = max_concurrency
+        self.lease_timeout = lease_timeout
+        self.breaker = breaker or CircuitBreaker()
+
+        self.workers = []
+        self.waiting = 0
+        self._cond = threading.Condition()
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._cond:
+            while len(self.workers) < self.size:
+                self.workers.append(self.factory())
+
+        for worker in self.workers:
+            if not worker.alive:
+                self._start_worker(worker)
+
+    def stop(self):
+        with self._cond:
+            workers, self.workers = self.workers, []
+
+        for worker in workers:
+            try:
+                worker.stop()
+            except Exception:
+                pass
+
+    def _start_worker(self, worker, restart=False):
+        try:
+            if restart:
+                worker.restart()
+            else:
+                worker.start()
+        except Exception as exc:
+            worker.last_error = str(exc)
+            self.breaker.record_failure()
+            return False
+        return True
+
+    def _acquire(self, timeout):
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        with self._cond:
+            self.waiting += 1
+            try:
+                while True:
+                    candidates = [w for w in self.workers if w.alive and w.busy < self.max_concurrency]
+                    if candidates:
+                        worker = min(candidates, key=lambda w: w.busy)
+                        worker.busy += 1
+                        return worker
+
+                    if not any(w.alive or w.restarting for w in self.workers):
+                        raise PoolUnavailable("No healthy workers available")
+
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise PoolUnavailable("Timed out waiting for an idle worker")
+                    self._cond.wait(remaining)
+            finally:
+                self.waiting -= 1
+
+    def _release(self, worker):
+        with self._cond:
+            worker.busy -= 1
+            self._cond.notify()
+
+    @contextmanager
+    def lease(self, timeout=None):
+        if not self.breaker.allow():
+            raise PoolUnavailable("Circuit breaker is open")
+
+        crashed = []
+        with self._start_lock:
+            if not self.workers:
+                self.start()
+            else:
+                # Bring back any workers that crashed since the last lease.
+                # They're restarted outside the lock, so a slow start doesn't
+                # hold up leases of the other workers.
+                with self._cond:
+                    for worker in self.workers:
+                        if not worker.alive and worker.busy == 0 and not worker.restarting:
+                            worker.restarting = True
+                            crashed.append(worker)
+
+        for worker in crashed:
+            try:
+                self._start_worker(worker, restart=True)
+            finally:
+                with self._cond:
+                    worker.restarting = False
+                    self._cond.notify_all()
+
+        worker = self._acquire(self.lease_timeout if timeout is None else timeout)
+
+        try:
+            yield worker
+        except Exception as exc:
+            if worker.alive:
+                # The worker is fine, the job itself failed
+                self.breaker.record_success()
+                raise
+
+            worker.failures += 1
+            worker.last_error = str(exc)
+            self.breaker.record_failure()
+            self._start_worker(worker, restart=True)
+
+            raise WorkerFailed(str(exc)) from exc
+        else:
+            worker.completed += 1
+            self.breaker.record_success()
+        finally:
+            self._release(worker)
+
+    def stats(self):
+        with self._cond:
+            workers = list(self.workers)
+
+        healthy = [w for w in workers if w.alive]
+
+        return {
+            "size": self.size,
+            "healthy": len(healthy),
+            "capacity": len(healthy) * self.max_concurrency,
+            "busy": sum(w.busy for w in workers),
+            "waiting": self.waiting,
+            "breaker": self.breaker.state,
+            "workers": [w.stats() for w in workers],
+        }
+
+
+__pools = {}
+__pools_lock = threading.Lock()
+
+
+def get_pool(name, create=None):
+    with __pools_lock:
+        if name not in __pools and create is not None:
+            __pools[name] = create()
+        return __pools.get(name)
+
+
+def get_pools():
+    with __pools_lock:
+        return dict(__pools)
+
+
+@atexit.register
+def stop_pools():
+    for pool in get_pools().values():
+        pool.stop()
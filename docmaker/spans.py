@@ -0,0 +1,57 @@
+import contextvars
+import time
+from contextlib import contextmanager
+
+
+# The span currently open, as (ctx, span). It's a context variable rather than
+# a thread local so that tasks run on other threads can be given the context
+# of the code that started them, and nest under its span.
+__current = contextvars.ContextVar("docmaker_span", default=None)
+
+
+@contextmanager
+def span(ctx, name):
+    """Record how long the block takes as a span of ctx
+
+    Spans opened inside the block, including in tasks run concurrently from
+    it, are nested under this one. Times are taken from a monotonic clock,
+    with `start` relative to when ctx was created.
+    """
+    current = __current.get()
+    if current is not None and current[0] is ctx:
+        parent = current[1]["spans"]
+    else:
+        parent = ctx.spans
+
+    start = time.perf_counter()
+    record = {
+        "name": name,
+        "start": round(start - ctx.started, 6),
+        "duration": None,
+        "spans": [],
+    }
+    parent.append(record)
+
+    token = __current.set((ctx, record))
+    try:
+        yield record
+    finally:
+        record["duration"] = round(time.perf_counter() - start, 6)
+        __current.reset(token)
+
+
+def walk_spans(spans, depth=0):
+    """Yield (depth, span) for each span in a tree of spans"""
+    for record in spans:
+        yield (depth, record)
+        yield from walk_spans(record["spans"], depth + 1)
+
+
+def format_spans(spans):
+    """Return a tree of spans as text, one span per line"""
+    lines = []
+    for (depth, record) in walk_spans(spans):
+        duration = "-" if record["duration"] is None else f"{record['duration']:.4f}"
+        skipped = " (skipped)" if record.get("skipped") else ""
+        lines.append(f"{record['start']:>9.4f} {duration:>9} {'  ' * depth}{record['name']}{skipped}")
+    return "\n".join(lines)
@@ -0,0 +1,162 @@
+import os
+import sys
+import time
+import traceback
+
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+
+from .batch import get_output_files
+from .docmaker import Docmaker
+from .pandoc import get_document_inputs
+
+
+class PollingWatcher:
+    """Notices changes by checking the size and mtime of each file"""
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.stats = {}
+
+    @staticmethod
+    def stat(path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def watch(self, paths):
+        self.stats = {path: self.stats.get(path) or self.stat(path) for path in paths}
+
+    def check(self):
+        changed = set()
+        for (path, stat) in self.stats.items():
+            new_stat = self.stat(path)
+            if new_stat != stat:
+                self.stats[path] = new_stat
+                changed.add(path)
+        return changed
+
+    def wait(self, timeout=None):
+        start = time.monotonic()
+        while True:
+            time.sleep(self.interval if timeout is None else min(self.interval, timeout))
+
+            changed = self.check()
+            if changed or (timeout is not None and time.monotonic() - start >= timeout):
+                return changed
+
+
+class InotifyWatcher:
+    """Notices changes with inotify, watching the directory of each file
+
+    Directories are watched rather than files, since many editors save by
+    replacing the file.
+    """
+
+    FLAGS = (flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE) if INotify else None
+
+    def __init__(self):
+        self.inotify = INotify()
+        self.dirs = {}
+        self.paths = set()
+
+    def watch(self, paths):
+        self.paths = set(paths)
+
+        for dirname in {os.path.dirname(path) for path in self.paths}:
+            if dirname not in self.dirs.values() and os.path.isdir(dirname):
+                self.dirs[self.inotify.add_watch(dirname, self.FLAGS)] = dirname
+
+    def wait(self, timeout=None):
+        events = self.inotify.read(timeout=None if timeout is None else int(timeout * 1000))
+
+        changed = {os.path.join(self.dirs[event.wd], event.name) for event in events if event.wd in self.dirs}
+        return changed & self.paths
+
+
+def get_watcher():
+    if INotify is not None:
+        return InotifyWatcher()
+    return PollingWatcher()
+
+
+def render(docmaker, document, output_file):
+    if document["options"]:
+        docmaker = Docmaker(
+            features=docmaker.features,
+            options=dict(docmaker.options, **document["options"])
+        )
+
+    if os.path.dirname(output_file):
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+
+    start = time.time()
+    try:
+        docmaker.render(document["srcfile"], output_file)
+    except Exception:  # pylint: disable=broad-except
+        print(f"Failed to render {document['srcfile']}", file=sys.stderr)
+        traceback.print_exc()
+    else:
+        print(f"Rendered {output_file} in {round(time.time() - start, 2)}s", file=sys.stderr)
+
+
+def watch(load, documents, output_dir=None, debounce=0.2):
+    """Render documents, and render them again when their inputs change
+
+    load is called to get the features, options and option files, and is
+    called again when any of the option files change. The Docmaker is kept
+    between renders, so hook plans, cached reference docs and conversion
+    workers stay warm. If the options can't be loaded again, the error is
+    printed and the previous Docmaker is kept until they're fixed.
+    """
+    watcher = get_watcher()
+
+    stale = set(range(len(documents)))
+    inputs = {}
+    option_files = set()
+    docmaker = None
+    reload = True
+
+    while True:
+        if reload:
+            reload = False
+            try:
+                features, options, new_option_files = load()
+                new_docmaker = Docmaker(features=features, options=options)
+            except Exception:  # pylint: disable=broad-except
+                if docmaker is None:
+                    raise
+                print("Failed to load options, still using the previous options", file=sys.stderr)
+                traceback.print_exc()
+                stale = set()
+            else:
+                (docmaker, option_files) = (new_docmaker, new_option_files)
+                stale = set(range(len(documents)))
+
+        output_format = docmaker.options.get("output") or "pdf"
+        output_files = get_output_files(documents, output_format, output_dir)
+
+        for idx in sorted(stale):
+            document = documents[idx]
+            render(docmaker, document, output_files[idx])
+            inputs[idx] = get_document_inputs(document, docmaker.options)
+
+        watcher.watch(set(option_files).union(*inputs.values()))
+
+        changed = watcher.wait()
+        while True:
+            # Wait for things to settle, as saving often takes several writes
+            more = watcher.wait(debounce)
+            if not more:
+                break
+            changed |= more
+
+        if changed & set(option_files):
+            reload = True
+            continue
+
+        stale = {idx for (idx, paths) in inputs.items() if paths & changed}
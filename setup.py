@@ -30,6 +30,7 @@ setup(
         "docx-mailmerge",
         "docxcompose",
         "falcon",
+        "ijson",
         "jinja2",
         "multipart",
         "python-dateutil",
@@ -0,0 +1,37 @@
+from contextlib import contextmanager
+
+from docmaker.pandoc import PandocServerBackend
+
+
+class FakeServer:
+    def __init__(self):
+        self.payloads = []
+
+    def post(self, payload):
+        self.payloads.append(payload)
+        return b"converted"
+
+
+class FakePool:
+    def __init__(self, server):
+        self.server = server
+
+    @contextmanager
+    def lease(self):
+        yield self.server
+
+
+def test_server_backend_normalizes_formats(tmp_path):
+    srcfile = tmp_path / "doc.md"
+    srcfile.write_text("# Title\n")
+
+    server = FakeServer()
+    backend = PandocServerBackend(FakePool(server))
+
+    contents = backend.convert_file(
+        str(srcfile), None, format="md", to="docx", cworkdir=str(tmp_path)
+    )
+
+    assert contents == b"converted"
+    assert server.payloads[0]["from"] == "markdown"
+    assert server.payloads[0]["to"] == "docx"